@@ -0,0 +1,68 @@
+#!/usr/bin/python
+# encoding: utf-8
+
+import sys
+import os
+from os.path import dirname, abspath, join
+import shutil
+import tempfile
+import time
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from synthetic_library import make_library
+
+
+"""Time `uf` content searches of a 10k-sheet library with each backend.
+
+The first search with 'index' or 'fts' builds its index in a temporary
+workflow cache dir, so it is reported separately from later searches. The
+'mdfind' backend is left out, needing Spotlight. Run on macOS or Linux.
+
+"""
+
+
+N_GROUPS = 400
+N_SHEETS = 10000
+
+QUERIES = [u'alpha', u'caf', u'novel chap', u'zzz']
+
+
+def time_search(backend, wf, groups, sheets, query):
+    start = time.time()
+    found_groups, found_sheets = backend.filter(wf, groups, sheets, query)
+    return time.time() - start, len(found_groups) + len(found_sheets)
+
+
+def main():
+    tmpdir = tempfile.mkdtemp()
+    # Keep the benchmark's indexes out of the real workflow cache dir
+    os.environ['alfred_workflow_cache'] = join(tmpdir, 'cache')
+    os.environ['alfred_workflow_data'] = join(tmpdir, 'data')
+    import workflow
+    import parse_ulysses
+    import content_search
+    try:
+        rootgroupdir = join(tmpdir, 'Groups-ulgroup')
+        make_library(rootgroupdir, N_GROUPS, N_SHEETS)
+        tree = parse_ulysses.create_tree(rootgroupdir, None, {})
+        groups, sheets = parse_ulysses.walk(tree)
+        wf = workflow.Workflow3()
+        print('%i groups, %i sheets' % (len(groups), len(sheets)))
+        print('%-8s %-12s %8s %9s' % ('backend', 'query', 'found', 'seconds'))
+        for name in ['scan', 'index', 'fts']:
+            backend = content_search.BACKENDS[name]()
+            elapsed, _ = time_search(backend, wf, groups, sheets, QUERIES[0])
+            if name != 'scan':
+                print('%-8s %-12s %8s %9.3f' % (name, '(build)', '', elapsed))
+            for query in QUERIES:
+                elapsed, found = time_search(backend, wf, groups, sheets,
+                                             query)
+                print('%-8s %-12s %8i %9.3f' % (
+                    name, query.encode('utf-8'), found, elapsed))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
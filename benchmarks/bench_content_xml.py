@@ -0,0 +1,93 @@
+#!/usr/bin/python
+# encoding: utf-8
+
+import sys
+import os
+from os.path import dirname, abspath, join
+import shutil
+import tempfile
+import time
+from xml.dom import minidom
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import sheet_content
+from synthetic_library import make_content_xml
+
+
+"""Time reading Ulysses 13+ Content.xml files with sheet_content against
+parsing them whole with xml.dom.minidom.
+
+For each sheet size the title (first paragraph) and the full text are
+read both ways, and the results checked to be the same.
+
+"""
+
+
+PARAGRAPH_COUNTS = [10, 1000, 20000]  # 20000 paragraphs is about 8MB
+REPEATS = 3
+
+
+def dom_paragraphs(path):
+    """Text of each paragraph in <string>, leaving out <attribute> text"""
+    def text(node):
+        if node.nodeType == node.TEXT_NODE:
+            return node.data
+        if node.nodeType == node.ELEMENT_NODE and node.tagName == 'attribute':
+            return u''
+        return u''.join(text(child) for child in node.childNodes)
+
+    document = minidom.parse(path)
+    string = document.getElementsByTagName('string')[0]
+    return [text(p) for p in string.getElementsByTagName('p')]
+
+
+def dom_title(path):
+    return dom_paragraphs(path)[0]
+
+
+def dom_text(path):
+    return u'\n'.join(dom_paragraphs(path)) + u'\n'
+
+
+def streamed_title(path):
+    return sheet_content.read_title(dirname(path))
+
+
+def streamed_text(path):
+    return u''.join(sheet_content.iter_text(dirname(path)))
+
+
+def best_time(func, path):
+    times = []
+    for _ in range(REPEATS):
+        start = time.time()
+        result = func(path)
+        times.append(time.time() - start)
+    return min(times), result
+
+
+def main():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print('%11s %-6s %10s %10s %8s' % (
+            'paragraphs', 'read', 'dom', 'streamed', 'speedup'))
+        for n in PARAGRAPH_COUNTS:
+            path = join(tmpdir, '%i.ulysses' % n, sheet_content.CONTENT_FILE)
+            os.mkdir(dirname(path))
+            make_content_xml(path, n)
+            for label, dom_func, streamed_func in [
+                    ('title', dom_title, streamed_title),
+                    ('text', dom_text, streamed_text)]:
+                dom_seconds, expected = best_time(dom_func, path)
+                streamed_seconds, result = best_time(streamed_func, path)
+                assert result == expected, label
+                print('%11i %-6s %10.4f %10.4f %7.0fx' % (
+                    n, label, dom_seconds, streamed_seconds,
+                    dom_seconds / streamed_seconds))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+# encoding: utf-8
+
+import sys
+import os
+from os.path import dirname, abspath, join
+import shutil
+import tempfile
+import time
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from bench_fuzzy_scorers import make_keys
+
+
+"""Time a keystroke's fuzzy filtering of 1k, 10k and 20k keys, end to end.
+
+'scan' is Workflow.filter over the keys, as before fuzzy was used. The
+others are fuzzy.load_corpus, from a corpus saved by an earlier call, and
+then filter_in_session in a new session, so they include unpickling the
+corpus and checking its keys, but not refining. 'corpus' is without a
+trigram index and 'corpus+index' with one. The first call, which prepares
+and saves the corpus, is reported as '(build)'.
+
+"""
+
+
+SIZES = [1000, 10000, 20000]
+
+QUERIES = [u'a', u'nov', u'caf draft', u'zzz']
+
+MAX_RESULTS = 50
+
+
+def best_time(func, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main():
+    tmpdir = tempfile.mkdtemp()
+    # Keep the benchmark's corpora out of the real workflow cache dir
+    os.environ['alfred_workflow_cache'] = join(tmpdir, 'cache')
+    os.environ['alfred_workflow_data'] = join(tmpdir, 'data')
+    import workflow
+    from workflow.workflow import MATCH_ALL, MATCH_ALLCHARS
+    import fuzzy
+    match_on = MATCH_ALL ^ MATCH_ALLCHARS
+    try:
+        wf = workflow.Workflow3()
+
+        def scan(keys, query):
+            wf.filter(query, list(keys), match_on=match_on,
+                      max_results=MAX_RESULTS)
+
+        def from_corpus(index):
+            def run(keys, query):
+                wf.clear_session_cache()
+                corpus = fuzzy.load_corpus(wf, 'bench-%s' % index,
+                                           list(keys), index)
+                fuzzy.filter_in_session(wf, 'bench', corpus, query,
+                                        match_on=match_on,
+                                        max_results=MAX_RESULTS)
+            return run
+
+        runs = [('scan', scan), ('corpus', from_corpus(False)),
+                ('corpus+index', from_corpus(True))]
+        print('%6s %-10s %s' % ('keys', 'query', ' '.join(
+            '%12s' % name for name, _ in runs)))
+        for size in SIZES:
+            keys = make_keys(size)
+            wf.clear_cache()
+            print('%6i %-10s %s' % (size, '(build)', ' '.join(
+                '%12.3f' % best_time(lambda: run(keys, QUERIES[0]), 1)
+                for _, run in runs)))
+            for query in QUERIES:
+                print('%6i %-10s %s' % (size, query.encode('utf-8'), ' '.join(
+                    '%12.3f' % best_time(lambda: run(keys, query))
+                    for _, run in runs)))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
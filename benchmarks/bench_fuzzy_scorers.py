@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# encoding: utf-8
+
+import sys
+from os.path import dirname, abspath
+import random
+import time
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from synthetic_library import WORDS
+
+import fuzzy
+import fuzzy_batch
+from workflow.workflow import MATCH_ALL, MATCH_ALLCHARS
+
+
+"""Time fuzzy filtering of 1k, 10k and 100k keys, key by key and in batch.
+
+Keys look like the Ulysses paths `uls` searches. The key-by-key scorer is
+run without its trigram index, so each scores every key. The batch scorer
+is timed with NumPy, if it is installed, and in Python. That their results
+agree is checked by tests/test_fuzzy.py.
+
+Each time is for a keystroke: the corpus is made again from its saved
+state, as load_corpus does, and the batch scorers lay it out before
+scoring. The 'load' column is the time to make the corpus alone.
+
+"""
+
+
+SIZES = [1000, 10000, 100000]
+
+QUERIES = [u'a', u'nov', u'caf draft', u'ndc', u'zzz']
+
+MATCH_ONS = [('all', MATCH_ALL), ('no-allchars', MATCH_ALL ^ MATCH_ALLCHARS)]
+
+
+def make_keys(n, seed=0):
+    rng = random.Random(seed)
+    keys = []
+    for _ in range(n):
+        path = [u'Main'] + [u' '.join(rng.sample(WORDS, 2)).title()
+                            for _ in range(rng.randint(0, 3))]
+        keys.append(u' '.join(path + rng.sample(WORDS, 3)))
+    return keys
+
+
+def best_time(func, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        times.append(time.time() - start)
+    return min(times), result
+
+
+def main():
+    numpy = fuzzy_batch.import_numpy()
+    scorers = [('item', False, None)]
+    if numpy is not None:
+        scorers.append(('batch', True, numpy))
+    scorers.append(('batch-py', True, None))
+    print('%7s %-12s %-10s %9s %s' % ('keys', 'match_on', 'query', 'load',
+                                      ' '.join('%9s' % name
+                                               for name, _, _ in scorers)))
+    for size in SIZES:
+        keys = make_keys(size)
+        state = fuzzy.PreparedCorpus(keys).state()
+        load_time, _ = best_time(lambda: fuzzy.PreparedCorpus.from_state(
+            state, keys))
+        for match_on_name, match_on in MATCH_ONS:
+            for query in QUERIES:
+                times = []
+                for name, batch, numpy in scorers:
+                    fuzzy_batch.numpy = numpy
+                    elapsed, _ = best_time(
+                        lambda: fuzzy.PreparedCorpus.from_state(
+                            state, keys).filter(query, match_on=match_on,
+                                                batch=batch))
+                    times.append(elapsed)
+                print('%7i %-12s %-10s %9.4f %s' % (
+                    size, match_on_name, query.encode('utf-8'), load_time,
+                    ' '.join('%9.4f' % t for t in times)))
+
+
+if __name__ == '__main__':
+    main()
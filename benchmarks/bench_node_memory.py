@@ -0,0 +1,142 @@
+#!/usr/bin/python
+# encoding: utf-8
+
+import sys
+import os
+from os.path import dirname, abspath, join
+import cPickle
+import shutil
+import tempfile
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import parse_ulysses
+from synthetic_library import make_library
+
+
+"""Measure memory per node of the tree for a 50k-sheet library.
+
+Compares the __slots__ nodes of parse_ulysses, which keep only their own
+directory name, with the previous plain classes, which kept a __dict__ and
+full dirpath and openable_file strings. Bytes are those of the node and
+the objects only it refers to (strings, floats, its lists), as reported
+by sys.getsizeof; nodes referred to by other nodes are not counted twice.
+
+"""
+
+
+N_GROUPS = 2000
+N_SHEETS = 50000
+
+# As found under ~/Library/Mobile Documents
+LIBRARY_SUBDIR = join('Library', 'Mobile Documents',
+                      'X5AZV975AG~com~soulmen~ulysses3', 'Documents',
+                      'Library', 'Groups-ulgroup')
+
+
+class LegacyGroup:
+    pass
+
+
+class LegacySheet:
+    pass
+
+
+def legacy_copy(group, parent=None):
+    """Return copy of tree using plain classes with the previous attributes"""
+    legacy = LegacyGroup()
+    legacy.dirpath = group.dirpath
+    legacy.parent_group = parent
+    legacy.mtime = group.stamp
+    legacy.listing = group.listing
+    legacy.sheet_count = group.sheet_count
+    legacy.index = None
+    legacy.descendent_count = group.descendent_count
+    legacy.openable_file = group.openable_file
+    legacy.name = legacy.title = group.name
+    legacy.child_sheets = []
+    for sheet in group.child_sheets:
+        legacy_sheet = LegacySheet()
+        legacy_sheet.dirpath = legacy_sheet.openable_file = sheet.dirpath
+        legacy_sheet.parent_group = legacy
+        legacy_sheet.mtime = sheet.stamp
+        legacy_sheet._first_line = sheet.first_line
+        legacy.child_sheets.append(legacy_sheet)
+    legacy.child_groups = [legacy_copy(g, legacy) for g in group.child_groups]
+    return legacy
+
+
+def attribute_values(node):
+    if hasattr(node, '__dict__'):
+        return node.__dict__.values()
+    return [getattr(node, slot)
+            for cls in type(node).__mro__
+            for slot in getattr(cls, '__slots__', ())]
+
+
+def node_bytes(node, seen):
+    size = sys.getsizeof(node)
+    if hasattr(node, '__dict__'):
+        size += sys.getsizeof(node.__dict__)
+    for value in attribute_values(node):
+        if id(value) in seen:
+            continue
+        seen.add(id(value))
+        if isinstance(value, (str, unicode, float)):
+            size += sys.getsizeof(value)
+        elif isinstance(value, list):
+            size += sys.getsizeof(value)
+            size += sum(sys.getsizeof(v) for v in value
+                        if isinstance(v, (str, unicode)))
+    return size
+
+
+def measure(label, groups, sheets):
+    seen = set()
+    group_bytes = sum(node_bytes(g, seen) for g in groups)
+    sheet_bytes = sum(node_bytes(s, seen) for s in sheets)
+    print('%-10s %12.0f %12.0f %12.0f %14i' % (
+        label, float(group_bytes) / len(groups),
+        float(sheet_bytes) / len(sheets),
+        float(group_bytes + sheet_bytes) / (len(groups) + len(sheets)),
+        group_bytes + sheet_bytes))
+
+
+def legacy_walk(group):
+    groups = [group]
+    sheets = list(group.child_sheets)
+    for child in group.child_groups:
+        more_groups, more_sheets = legacy_walk(child)
+        groups += more_groups
+        sheets += more_sheets
+    return groups, sheets
+
+
+def main():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        rootgroupdir = join(tmpdir, LIBRARY_SUBDIR)
+        os.makedirs(dirname(rootgroupdir))
+        make_library(rootgroupdir, N_GROUPS, N_SHEETS, body_words=5)
+        tree = parse_ulysses.create_tree(rootgroupdir, None, {})
+        groups, sheets = parse_ulysses.walk(tree)
+        for sheet in sheets:
+            sheet.first_line
+        legacy_tree = legacy_copy(tree)
+        legacy_groups, legacy_sheets = legacy_walk(legacy_tree)
+
+        print('%i groups, %i sheets under %s' % (
+            len(groups), len(sheets), rootgroupdir))
+        print('%-10s %12s %12s %12s %14s' % (
+            'model', 'bytes/group', 'bytes/sheet', 'bytes/node',
+            'total bytes'))
+        measure('legacy', legacy_groups, legacy_sheets)
+        measure('slots', groups, sheets)
+        print('pickled snapshot: legacy %i bytes, slots %i bytes' % (
+            len(cPickle.dumps(legacy_tree, -1)), len(cPickle.dumps(tree, -1))))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/python
+# encoding: utf-8
+
+import sys
+import os
+from os.path import dirname, abspath, join
+import __builtin__
+import shutil
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import parse_ulysses
+from synthetic_library import make_library
+
+
+"""Count filesystem calls made building the tree of a 10k-sheet library.
+
+Compares create_tree against the original listdir, filter and exists-check
+approach. Titles are read lazily by create_tree, so every sheet's title is
+asked for in the timed builds, as the legacy builder reads them all. Calls
+are counted where Python makes them (os.listdir, os.stat, open), each of
+which is one system call (or an open/read/close sequence).
+
+"""
+
+
+N_GROUPS = 400
+N_SHEETS = 10000
+
+
+def legacy_create_tree(rootgroupdir, parent_group):
+    """create_tree as it was: listdir, two filters and an exists per sheet"""
+    filelist = os.listdir(rootgroupdir)
+    assert 'Info.ulgroup' in filelist
+    sheetdirlist = [p for p in filelist if p.endswith('.ulysses')]
+    groupdirlist = [p for p in filelist if p.endswith('-ulgroup')]
+    group = parse_ulysses.Group(rootgroupdir, parent_group)
+    for sheetdir in sheetdirlist:
+        path = join(rootgroupdir, sheetdir, 'Text.txt')
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                f.readline().decode('utf-8').strip()
+    for child_groupdir in groupdirlist:
+        legacy_create_tree(join(rootgroupdir, child_groupdir), group)
+    return group
+
+
+def create_tree_with_titles(*args):
+    """create_tree, then read every sheet's title"""
+    tree = parse_ulysses.create_tree(*args)
+    _, sheets = parse_ulysses.walk(tree)
+    for sheet in sheets:
+        sheet.first_line
+    return tree
+
+
+def count_calls(func, *args):
+    counts = Counter()
+
+    def counting(name, real):
+        def wrapper(*a, **kw):
+            counts[name] += 1
+            return real(*a, **kw)
+        return wrapper
+
+    patched = [(os, 'listdir'), (os, 'stat'), (os, 'lstat'),
+               (__builtin__, 'open')]
+    originals = [(module, name, getattr(module, name))
+                 for module, name in patched]
+    for module, name, real in originals:
+        setattr(module, name, counting(name, real))
+    try:
+        start = time.time()
+        func(*args)
+        elapsed = time.time() - start
+    finally:
+        for module, name, real in originals:
+            setattr(module, name, real)
+    return counts, elapsed
+
+
+def main():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        rootgroupdir = join(tmpdir, 'Groups-ulgroup')
+        make_library(rootgroupdir, N_GROUPS, N_SHEETS)
+        print('%i groups, %i sheets' % (N_GROUPS + 1, N_SHEETS))
+        print('%-26s %8s %8s %8s %8s %9s' % (
+            'builder', 'listdir', 'stat', 'open', 'total', 'seconds'))
+        for label, func, args in [
+                ('legacy', legacy_create_tree, (rootgroupdir, None)),
+                ('create_tree', create_tree_with_titles,
+                 (rootgroupdir, None)),
+                ('create_tree incremental', create_tree_with_titles,
+                 (rootgroupdir, None, {})),
+                ]:
+            counts, elapsed = count_calls(func, *args)
+            print('%-26s %8i %8i %8i %8i %9.3f' % (
+                label, counts['listdir'], counts['stat'] + counts['lstat'],
+                counts['open'], sum(counts.values()), elapsed))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
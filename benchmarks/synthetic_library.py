@@ -0,0 +1,69 @@
+# encoding: utf-8
+
+import os
+from os.path import join
+import random
+
+import biplist
+
+
+"""Create synthetic Ulysses libraries on disk for benchmarking.
+
+Mimics the layout parse_ulysses reads: nested '-ulgroup' directories each
+holding a binary Info.ulgroup plist, and '.ulysses' sheet packages holding
+a Text.txt whose first line is the sheet's title.
+
+"""
+
+
+WORDS = (u'alpha beta gamma delta epsilon project novel chapter draft notes '
+         u'ideas café research outline scene letter journal essay').split()
+
+
+def make_library(rootgroupdir, n_groups, n_sheets, body_words=50, seed=0):
+    """Create a library of n_groups groups and n_sheets sheets.
+
+    Groups are nested at random under rootgroupdir and sheets spread over
+    them. Return list of all group directories.
+    """
+    rng = random.Random(seed)
+    _make_group(rootgroupdir, u'Main')
+    groupdirs = [rootgroupdir]
+    for i in range(n_groups):
+        groupdir = join(rng.choice(groupdirs), '%08x-ulgroup' % i)
+        _make_group(groupdir, u' '.join(rng.sample(WORDS, 2)).title())
+        groupdirs.append(groupdir)
+    for i in range(n_sheets):
+        sheetdir = join(rng.choice(groupdirs), '%08x.ulysses' % i)
+        os.mkdir(sheetdir)
+        title = u'# ' + u' '.join(rng.sample(WORDS, 3))
+        body = u' '.join(rng.choice(WORDS) for _ in range(body_words))
+        with open(join(sheetdir, 'Text.txt'), 'w') as f:
+            f.write((title + u'\n' + body + u'\n').encode('utf-8'))
+    return groupdirs
+
+
+def _make_group(groupdir, name):
+    os.mkdir(groupdir)
+    biplist.writePlist({'displayName': name}, join(groupdir, 'Info.ulgroup'))
+
+
+def make_content_xml(path, n_paragraphs, words_per_paragraph=50, seed=0):
+    """Write a Ulysses 13+ Content.xml of n_paragraphs to path"""
+    rng = random.Random(seed)
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<sheet version="5" app_version="13">'
+                '<markup version="1" identifier="markdownxl" '
+                'displayName="Markdown XL"/>'
+                '<string xml:space="preserve">\n')
+        title = u' '.join(rng.sample(WORDS, 3))
+        f.write((u'<p><tags><tag kind="heading1"># </tag></tags>%s</p>\n'
+                 % title).encode('utf-8'))
+        for _ in range(n_paragraphs - 1):
+            words = [rng.choice(WORDS) for _ in range(words_per_paragraph)]
+            words[1] = (u'<element kind="link"><attribute identifier="URL">'
+                        u'http://example.com</attribute>%s</element>'
+                        % words[1])
+            f.write((u'<p>%s</p>\n' % u' '.join(words)).encode('utf-8'))
+        f.write('</string></sheet>\n')
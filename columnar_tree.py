@@ -0,0 +1,466 @@
+from os.path import join
+from array import array
+import mmap
+import struct
+import zlib
+
+from workflow.workflow import atomic_writer
+
+import parse_ulysses
+
+
+"""Hold a tree of groups and sheets in parallel arrays.
+
+An alternative to the object graph built by parse_ulysses.create_tree for
+large libraries. Nodes are numbered in pre-order, each group followed by
+its own sheets and then its child groups, so the subtree of node i is the
+range [i, end[i]). Per node there is a parent index, a kind, and offsets
+of its title and directory name in a single UTF-8 string pool. Walking,
+ancestors and descendent counts are index arithmetic over these arrays,
+and the whole store is saved as one contiguous buffer.
+
+The saved file is laid out as a header, the node table (one column after
+another), and the string pool. load() memory-maps it and reads columns in
+place, so nothing is copied or decoded but the values a query asks for.
+The header carries a format version, the sizes of the table and pool, and a
+CRC-32 of the header and the rest of the file, so a stale, short or torn
+file is rejected and the caller falls back to the pickled tree until the
+indexer writes a new one. As atomic_writer does not fsync, a crash can
+leave a file of the right size holding zeroes or old data, so the
+checksum is checked on every load; it costs a pass over the file, well
+under the cost of unpickling a tree.
+
+Ancestors, their titles and directory paths are worked out once per group
+and kept, so looking them up for every node costs little more than for
+one.
+
+"""
+
+
+KIND_GROUP = 0
+KIND_SHEET = 1
+
+MAGIC = 'ULCT'
+VERSION = 3
+# magic, version, node count, pool size; then a CRC-32 of those fields and
+# everything after the header
+_FIELDS = struct.Struct('<4sIII')
+_HEADER = struct.Struct('<4sIIIi')
+_INT = struct.Struct('=i')  # as array('i') writes them
+
+# Columns in the order they are saved; all but kind hold 32 bit ints, and
+# sheets_before has one more entry than there are nodes. The name columns
+# form the path table: each node's directory name within the pool.
+_INT_COLUMNS = ['parent', 'title_offset', 'title_length', 'name_offset',
+                'name_length', 'end', 'sheets_before']
+
+
+class ColumnarTree(object):
+
+    def __init__(self):
+        self.parent = array('i')
+        self.kind = array('b')
+        self.title_offset = array('i')
+        self.title_length = array('i')
+        self.name_offset = array('i')  # directory name; root's is full path
+        self.name_length = array('i')
+        self.end = array('i')
+        self.sheets_before = array('i')  # sheets in [0, i); one extra entry
+        self.pool = ''
+        self._reset_paths()
+
+    def _reset_paths(self):
+        # By group index; filled in as asked for
+        self._lineages = {}
+        self._lineage_names = {}
+        self._ulysses_paths = {}
+        self._alfred_paths = {}
+        self._dirpaths = {}
+
+    @classmethod
+    def from_tree(cls, root_group):
+        """Return store holding the tree of parse_ulysses nodes"""
+        tree = cls()
+        pool = []
+        pool_size = [0]
+
+        def add_string(s):
+            if isinstance(s, unicode):
+                s = s.encode('utf-8')
+            pool.append(s)
+            pool_size[0] += len(s)
+            return pool_size[0] - len(s), len(s)
+
+        def add_node(node, kind, parent):
+            offset, length = add_string(node.title)
+            tree.title_offset.append(offset)
+            tree.title_length.append(length)
+            offset, length = add_string(node._dirname)
+            tree.name_offset.append(offset)
+            tree.name_length.append(length)
+            tree.parent.append(parent)
+            tree.kind.append(kind)
+            tree.end.append(len(tree.kind))  # groups' ends are set later
+            return len(tree.kind) - 1
+
+        # Iterative pre-order. A (None, i) marker is popped once all of group
+        # i's descendents have been added, closing its range.
+        stack = [(root_group, -1)]
+        while stack:
+            group, parent = stack.pop()
+            if group is None:
+                tree.end[parent] = len(tree.kind)
+                continue
+            assert group.sheet_count is None, 'tree was built without sheets'
+            i = add_node(group, KIND_GROUP, parent)
+            for sheet in group.child_sheets:
+                add_node(sheet, KIND_SHEET, i)
+            stack.append((None, i))
+            stack.extend((child, i) for child in reversed(group.child_groups))
+
+        tree.pool = ''.join(pool)
+        tree._count_sheets()
+        return tree
+
+    def _count_sheets(self):
+        self.sheets_before = array('i', [0])
+        n = 0
+        for kind in self.kind:
+            n += kind == KIND_SHEET
+            self.sheets_before.append(n)
+
+    def __len__(self):
+        return len(self.kind)
+
+    # Column access; a store read straight from a file can override these
+
+    def get_title(self, i):
+        offset = self.title_offset[i]
+        return self.pool[offset:offset + self.title_length[i]].decode('utf-8')
+
+    def get_name(self, i):
+        offset = self.name_offset[i]
+        return self.pool[offset:offset + self.name_length[i]]
+
+    def get_parent(self, i):
+        return self.parent[i]
+
+    def get_kind(self, i):
+        return self.kind[i]
+
+    def get_end(self, i):
+        return self.end[i]
+
+    def get_sheets_before(self, i):
+        return self.sheets_before[i]
+
+    # Tree operations as index arithmetic
+
+    def walk(self, i=0):
+        """Return (groups, sheets) under node i, as walk() in parse_ulysses"""
+        groups = []
+        sheets = []
+        for j in xrange(i, self.get_end(i)):
+            if self.get_kind(j) == KIND_GROUP:
+                groups.append(ColumnarNode(self, j))
+            else:
+                sheets.append(ColumnarNode(self, j))
+        return groups, sheets
+
+    def children(self, i, kind):
+        """Indexes of node i's children of given kind, in listing order"""
+        children = []
+        j = i + 1
+        end = self.get_end(i)
+        while j < end:
+            if self.get_kind(j) == kind:
+                children.append(j)
+            j = self.get_end(j)
+        return children
+
+    def ancestors(self, i):
+        """Indexes of node i's ancestors, outermost first"""
+        parent = self.get_parent(i)
+        return list(self.lineage(parent)) if parent != -1 else []
+
+    def lineage(self, i):
+        """Tuple of indexes of group i's ancestors and i, outermost first"""
+        lineage = self._lineages.get(i)
+        if lineage is None:
+            parent = self.get_parent(i)
+            lineage = (self.lineage(parent) if parent != -1 else ()) + (i,)
+            self._lineages[i] = lineage
+        return lineage
+
+    def lineage_names(self, i):
+        """Tuple of titles of group i's ancestors and i"""
+        names = self._lineage_names.get(i)
+        if names is None:
+            parent = self.get_parent(i)
+            names = ((self.lineage_names(parent) if parent != -1 else ()) +
+                     (self.get_title(i),))
+            self._lineage_names[i] = names
+        return names
+
+    def number_descendents(self, i):
+        return (self.get_sheets_before(self.get_end(i)) -
+                self.get_sheets_before(i))
+
+    def ulysses_path(self, i):
+        """Ulysses path of group i, as parse_ulysses.Group.ulysses_path"""
+        path = self._ulysses_paths.get(i)
+        if path is None:
+            parent = self.get_parent(i)
+            if parent != -1:
+                path = self.ulysses_path(parent) + '/' + self.get_title(i)
+            elif self.get_title(i) == parse_ulysses.MAIN_GROUP_NAME:
+                path = ''
+            else:
+                path = '/' + self.get_title(i)
+            self._ulysses_paths[i] = path
+        return path
+
+    def alfred_path(self, i):
+        """Alfred path of group i, as parse_ulysses.Group.alfred_path"""
+        path = self._alfred_paths.get(i)
+        if path is None:
+            parent = self.get_parent(i)
+            if parent != -1:
+                path = self.alfred_path(parent) + ' ' + self.get_title(i)
+            else:
+                path = self.get_title(i)
+            self._alfred_paths[i] = path
+        return path
+
+    def dirpath(self, i):
+        if self.get_kind(i) == KIND_SHEET:
+            return join(self.dirpath(self.get_parent(i)), self.get_name(i))
+        path = self._dirpaths.get(i)
+        if path is None:
+            parent = self.get_parent(i)
+            path = self.get_name(i)
+            if parent != -1:
+                path = join(self.dirpath(parent), path)
+            self._dirpaths[i] = path
+        return path
+
+    def find_group_by_path(self, dirpath):
+        """Return node for group at dirpath; KeyError if not found"""
+        components = parse_ulysses.group_path_components(self.get_name(0),
+                                                         dirpath)
+        i = 0
+        for component in components:
+            for child in self.children(i, KIND_GROUP):
+                if self.get_name(child) == component:
+                    i = child
+                    break
+            else:
+                raise KeyError("Group with dirpath '%s' not found" % dirpath)
+        return ColumnarNode(self, i)
+
+    def root(self):
+        return ColumnarNode(self, 0)
+
+    # Saving and loading as one buffer
+
+    def to_buffer(self):
+        body = ''.join([getattr(self, name).tostring()
+                        for name in _INT_COLUMNS] +
+                       [self.kind.tostring(), self.pool])
+        fields = (MAGIC, VERSION, len(self), len(self.pool))
+        crc = zlib.crc32(body, zlib.crc32(_FIELDS.pack(*fields)))
+        return _HEADER.pack(*(fields + (crc,))) + body
+
+
+def read_layout(data):
+    """Check buffer's header, size and checksum and return where columns
+    start.
+
+    Returns (node count, dict of column offsets, pool offset). ValueError
+    if the buffer is not a complete, intact store of the current version.
+    """
+    if len(data) < _HEADER.size:
+        raise ValueError('Columnar tree buffer truncated')
+    magic, version, n, pool_size, crc = _HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Not a version %i columnar tree' % VERSION)
+    offsets = {}
+    offset = _HEADER.size
+    for name in _INT_COLUMNS:
+        offsets[name] = offset
+        offset += (n + (name == 'sheets_before')) * _INT.size
+    offsets['kind'] = offset
+    offset += n
+    if len(data) != offset + pool_size:
+        raise ValueError('Columnar tree buffer is %i bytes, expected %i'
+                         % (len(data), offset + pool_size))
+    if zlib.crc32(buffer(data, _HEADER.size),
+                  zlib.crc32(data[:_FIELDS.size])) != crc:
+        raise ValueError('Columnar tree checksum mismatch')
+    return n, offsets, offset
+
+
+class MappedColumnarTree(ColumnarTree):
+    """A ColumnarTree reading its columns in place from a saved buffer.
+
+    Nothing is copied or decoded up front; each getter unpacks one value at
+    its offset, typically from a memory-mapped file.
+    """
+
+    def __init__(self, data):
+        self._data = data
+        self._n, offsets, self._pool_offset = read_layout(data)
+        self._parent = offsets['parent']
+        self._title_offset = offsets['title_offset']
+        self._title_length = offsets['title_length']
+        self._name_offset = offsets['name_offset']
+        self._name_length = offsets['name_length']
+        self._end = offsets['end']
+        self._sheets_before = offsets['sheets_before']
+        self._kind = offsets['kind']
+        self._reset_paths()
+
+    def _int(self, column, i):
+        return _INT.unpack_from(self._data, column + i * _INT.size)[0]
+
+    def _string(self, offset, length):
+        start = self._pool_offset + offset
+        return self._data[start:start + length]
+
+    def __len__(self):
+        return self._n
+
+    def get_title(self, i):
+        return self._string(self._int(self._title_offset, i),
+                            self._int(self._title_length, i)).decode('utf-8')
+
+    def get_name(self, i):
+        return self._string(self._int(self._name_offset, i),
+                            self._int(self._name_length, i))
+
+    def get_parent(self, i):
+        return self._int(self._parent, i)
+
+    def get_kind(self, i):
+        return ord(self._data[self._kind + i])
+
+    def get_end(self, i):
+        return self._int(self._end, i)
+
+    def get_sheets_before(self, i):
+        return self._int(self._sheets_before, i)
+
+    def to_buffer(self):
+        return self._data[:]
+
+
+class ColumnarNode(object):
+    """A ColumnarTree node, behaving like a parse_ulysses Group or Sheet"""
+    __slots__ = ('tree', 'i')
+
+    stamp = None  # not stored
+
+    def __init__(self, tree, i):
+        self.tree = tree
+        self.i = i
+
+    def __eq__(self, other):
+        return (isinstance(other, ColumnarNode) and
+                other.tree is self.tree and other.i == self.i)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __lt__(self, other):
+        # Break ties in Workflow.filter's sort by position in the tree
+        return self.i < other.i
+
+    @property
+    def is_group(self):
+        return self.tree.get_kind(self.i) == KIND_GROUP
+
+    @property
+    def is_sheet(self):
+        return self.tree.get_kind(self.i) == KIND_SHEET
+
+    @property
+    def title(self):
+        return self.tree.get_title(self.i)
+
+    name = first_line = title
+
+    @property
+    def dirpath(self):
+        return self.tree.dirpath(self.i)
+
+    @property
+    def openable_file(self):
+        if self.is_group:
+            return join(self.dirpath, 'Info.ulgroup')
+        return self.dirpath
+
+    @property
+    def parent_group(self):
+        parent = self.tree.get_parent(self.i)
+        return ColumnarNode(self.tree, parent) if parent != -1 else None
+
+    @property
+    def child_groups(self):
+        return [ColumnarNode(self.tree, j)
+                for j in self.tree.children(self.i, KIND_GROUP)]
+
+    @property
+    def child_sheets(self):
+        return [ColumnarNode(self.tree, j)
+                for j in self.tree.children(self.i, KIND_SHEET)]
+
+    @property
+    def ancestors(self):
+        return tuple(self.get_ancestors())
+
+    @property
+    def ancestor_path(self):
+        parent = self.tree.get_parent(self.i)
+        return self.tree.ulysses_path(parent) if parent != -1 else ''
+
+    @property
+    def ancestor_alfred_path(self):
+        parent = self.tree.get_parent(self.i)
+        return self.tree.alfred_path(parent) if parent != -1 else ''
+
+    def get_ancestors(self):
+        return [ColumnarNode(self.tree, j)
+                for j in self.tree.ancestors(self.i)]
+
+    def get_alfred_path_list(self):
+        parent = self.tree.get_parent(self.i)
+        return list(self.tree.lineage_names(parent)) if parent != -1 else []
+
+    def number_descendents(self):
+        return self.tree.number_descendents(self.i)
+
+
+def cache_file(wf, rootgroupdir):
+    return wf.cachefile(parse_ulysses.tree_cache_name(rootgroupdir) +
+                        '.columns')
+
+
+def save(wf, rootgroupdir, tree):
+    """Write columnar store for rootgroupdir to the workflow cache dir"""
+    with atomic_writer(cache_file(wf, rootgroupdir), 'wb') as f:
+        f.write(tree.to_buffer())
+
+
+def load(wf, rootgroupdir):
+    """Return store for rootgroupdir mapped from cache dir, or None.
+
+    The mapping stays valid after the indexer replaces the file, as
+    atomic_writer renames a new file over it rather than rewriting it.
+    """
+    try:
+        with open(cache_file(wf, rootgroupdir), 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return MappedColumnarTree(data)
+    except (EnvironmentError, ValueError) as e:
+        parse_ulysses.logger.info('No usable columnar tree: %s' % e)
+        return None
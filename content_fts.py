@@ -0,0 +1,189 @@
+import re
+import sqlite3
+
+import workflow
+import logging
+
+import content_index
+
+
+"""Search the text of Ulysses sheets with SQLite's FTS5, ranked by BM25.
+
+An alternative to content_index, used when the 'content_backend' setting
+is 'fts'. There is one row per sheet (and group) holding its title, its
+Ulysses path and its text, in a database in the workflow cache dir. Rows
+are brought up to date as in content_index. Bare query words match as
+prefixes, and words in double quotes as a phrase; results come best first.
+
+"""
+
+
+DATABASE_FILE = 'content.sqlite'
+
+# Bump whenever the schema or the text read changes; the database is then
+# rebuilt
+SCHEMA_VERSION = 4
+
+# SQLite module the content table uses; some builds of SQLite lack it
+FTS_MODULE = 'fts5'
+
+# BM25 weights of the title, ulysses_path and body columns
+COLUMN_WEIGHTS = (10.0, 5.0, 1.0)
+
+_QUERY_TERM = re.compile(r'"([^"]*)"|(\S+)', re.UNICODE)
+
+
+logger = workflow.Workflow3().logger
+logger.setLevel(logging.DEBUG)
+
+
+_available = None  # whether FTS_MODULE is, once checked
+
+
+def is_available():
+    """True if this SQLite has FTS_MODULE.
+
+    Checked, and logged if not, once per process.
+    """
+    global _available
+    if _available is None:
+        conn = sqlite3.connect(':memory:')
+        try:
+            conn.execute('CREATE VIRTUAL TABLE probe USING %s(text)'
+                         % FTS_MODULE)
+            _available = True
+        except sqlite3.OperationalError as e:
+            logger.warn('SQLite has no %s (%s); content searches fall '
+                        'back to the content index' % (FTS_MODULE, e))
+            _available = False
+        finally:
+            conn.close()
+    return _available
+
+
+def connect(wf):
+    """Return connection to content database, creating it if need be.
+
+    sqlite3.OperationalError if this SQLite was built without FTS5.
+    """
+    conn = sqlite3.connect(wf.cachefile(DATABASE_FILE), timeout=10)
+    conn.text_factory = str  # paths are byte strings, as in the tree
+    # Let readers in while the indexer writes
+    conn.execute('PRAGMA journal_mode=WAL')
+    if conn.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+        with conn:
+            conn.execute('DROP TABLE IF EXISTS docs')
+            conn.execute('DROP TABLE IF EXISTS content')
+            conn.execute('CREATE TABLE docs (id INTEGER PRIMARY KEY, '
+                         'path TEXT UNIQUE, stamp)')
+            conn.execute("CREATE VIRTUAL TABLE content USING %s(title, "
+                         "ulysses_path, body, "
+                         "tokenize='unicode61 remove_diacritics 1')"
+                         % FTS_MODULE)
+            conn.execute('PRAGMA user_version = %i' % SCHEMA_VERSION)
+    return conn
+
+
+def update(conn, nodes, prune=False):
+    """Index nodes not indexed since they last changed.
+
+    With prune, nodes are taken to be all there are and anything else
+    indexed is removed. Return number of rows added, updated or removed.
+    """
+    indexed = dict((path, (doc_id, stamp)) for doc_id, path, stamp in
+                   conn.execute('SELECT id, path, stamp FROM docs'))
+    seen = set()
+    changed = []
+    for node in nodes:
+        path = node.openable_file
+        seen.add(path)
+        stamp = row_stamp(node)
+        if stamp is None:
+            continue
+        if path not in indexed or indexed[path][1] != stamp:
+            changed.append((node, stamp))
+    removed = []
+    if prune:
+        removed = [path for path in indexed if path not in seen]
+    if not changed and not removed:
+        return 0
+
+    with conn:
+        for path in removed + [node.openable_file for node, _ in changed]:
+            if path in indexed:
+                doc_id = indexed[path][0]
+                conn.execute('DELETE FROM docs WHERE id = ?', (doc_id,))
+                conn.execute('DELETE FROM content WHERE rowid = ?', (doc_id,))
+        for node, stamp in changed:
+            cursor = conn.execute(
+                'INSERT INTO docs (path, stamp) VALUES (?, ?)',
+                (node.openable_file, stamp))
+            body = '' if node.is_group else content_index.node_text(node)
+            if not isinstance(body, unicode):
+                body = body.decode('utf-8', 'replace')
+            conn.execute('INSERT INTO content (rowid, title, ulysses_path, '
+                         'body) VALUES (?, ?, ?, ?)',
+                         (cursor.lastrowid, node.title,
+                          node.ancestor_path, body))
+    return len(changed) + len(removed)
+
+
+def row_stamp(node):
+    """Return what changes when node's row may have, or None if node has
+    gone.
+
+    As a row holds the node's Ulysses path as well as its text, this is
+    content_index.node_stamp with the path of the group node is in, so
+    renaming or moving a group updates the rows of everything in it.
+    """
+    stamp = content_index.node_stamp(node)
+    if stamp is None:
+        return None
+    # A byte string, as text_factory returns it
+    return (u'%r %s' % (stamp, node.ancestor_path)).encode('utf-8')
+
+
+def match_expression(query):
+    """Return FTS5 MATCH expression for query, or None if it has no words.
+
+    "quoted words" are a phrase; other words are prefixes. All must match.
+    Terms with no words the tokenizer keeps (such as "-") are left out, as
+    FTS5 matches nothing for them.
+    """
+    terms = []
+    for phrase, word in _QUERY_TERM.findall(query):
+        if content_index.words(phrase):
+            terms.append('"%s"' % phrase.replace('"', '""'))
+        elif content_index.words(word):
+            terms.append('"%s"*' % word.replace('"', '""'))
+    return ' AND '.join(terms) or None
+
+
+def search(conn, query):
+    """Return openable_files matching query, best match first"""
+    expression = match_expression(query)
+    if expression is None:
+        return []
+    return [path for path, in conn.execute(
+        'SELECT docs.path FROM content JOIN docs ON docs.id = content.rowid '
+        'WHERE content MATCH ? ORDER BY bm25(content, ?, ?, ?)',
+        (expression,) + COLUMN_WEIGHTS)]
+
+
+def update_and_search(wf, nodes, query, indexed=False):
+    """Return openable_files of nodes matching query, best match first,
+    after bringing the database up to date with nodes.
+
+    If indexed, the indexer keeps the database up to date, so it is only
+    searched, unless the indexer has yet to fill it.
+    """
+    conn = connect(wf)
+    try:
+        if not indexed or not conn.execute(
+                'SELECT 1 FROM docs LIMIT 1').fetchone():
+            changes = update(conn, nodes)
+            if changes:
+                logger.info('Content database: %i rows changed' % changes)
+        return search(conn, query)
+    finally:
+        conn.close()
@@ -0,0 +1,265 @@
+from os.path import join
+import errno
+import re
+import sqlite3
+import unicodedata
+from array import array
+from collections import defaultdict
+
+import workflow
+import logging
+
+import parse_ulysses
+import sheet_content
+
+
+"""Search the text of Ulysses sheets without Spotlight.
+
+An inverted index from words to the groups and sheets containing them,
+kept in an SQLite database in the workflow cache dir. The indexer brings
+it up to date as the library changes; without the indexer, it is brought
+up to date from the tree before each search. Sheets are re-read only if
+the mtime of their Text.txt or Content.xml has changed, groups only if
+their name has. Words are folded to lower case without diacritics, and a
+query matches a node if each of its words starts some word of the node's
+text; the same as mdfind's '"query*"cdw'.
+
+"""
+
+
+CONTENT_INDEX_FILE = 'content-index.sqlite'
+
+# Bump whenever the schema or the text read changes; the database is then
+# rebuilt
+CONTENT_INDEX_VERSION = 5
+
+# Fewer than any SQLite allows in a statement
+_MAX_VARIABLES = 500
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+_COMBINING = re.compile(u'[\u0300-\u036f]')
+
+
+logger = workflow.Workflow3().logger
+logger.setLevel(logging.DEBUG)
+
+
+def fold(text):
+    """Return text in lower case, with diacritics removed"""
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8', 'replace')
+    return _COMBINING.sub(u'', unicodedata.normalize('NFKD', text.lower()))
+
+
+def words(text):
+    """Return set of folded words in text"""
+    return set(_WORD.findall(fold(text)))
+
+
+def words_match(prefixes, text_words):
+    """True if every prefix starts one of text_words"""
+    return all(any(word.startswith(prefix) for word in text_words)
+               for prefix in prefixes)
+
+
+def node_stamp(node):
+    """Return what changes when node's text may have: a sheet's stamp (see
+    parse_ulysses.sheet_stamp) or a group's name. None if node has gone."""
+    if node.is_group:
+        return node.name
+    if node.stamp is not None:
+        return node.stamp
+    try:
+        return parse_ulysses.sheet_stamp(node.dirpath)
+    except OSError:
+        return None  # removed since tree was built
+
+
+def node_text(node):
+    """Return the text searched for node: a group's name or sheet's text"""
+    return node.name if node.is_group else read_sheet_text(node)
+
+
+def read_sheet_text(sheet):
+    """Return text of sheet from Text.txt, else Content.xml, or '' if it has
+    neither"""
+    try:
+        with open(join(sheet.dirpath, 'Text.txt'), 'r') as f:
+            return f.read()
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    return u''.join(sheet_content.iter_text(sheet.dirpath))
+
+
+class ContentIndex(object):
+    """Words in the text of groups and sheets, keyed by openable_file, in an
+    SQLite database.
+
+    There is a row per word, holding an array of the documents it is in,
+    kept in word order; so a search reads only the rows of words its own
+    prefixes start, however large the index. Documents are numbered, so
+    that each path is held once however many words it has.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    @classmethod
+    def open(cls, path):
+        """Return index in the database at path, creating it if need be"""
+        conn = sqlite3.connect(path, timeout=10)
+        conn.text_factory = str  # paths are byte strings, as in the tree
+        # Let readers in while the indexer writes
+        conn.execute('PRAGMA journal_mode=WAL')
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version != CONTENT_INDEX_VERSION:
+            with conn:
+                conn.execute('DROP TABLE IF EXISTS docs')
+                conn.execute('DROP TABLE IF EXISTS postings')
+                # A document's words are kept to take it out of postings,
+                # but are never read by a search
+                conn.execute('CREATE TABLE docs (id INTEGER PRIMARY KEY, '
+                             'path TEXT UNIQUE, stamp TEXT, words TEXT)')
+                conn.execute('CREATE TABLE postings (word TEXT PRIMARY KEY, '
+                             'docs BLOB) WITHOUT ROWID')
+                conn.execute('PRAGMA user_version = %i' %
+                             CONTENT_INDEX_VERSION)
+        return cls(conn)
+
+    def close(self):
+        self.conn.close()
+
+    def is_empty(self):
+        return not self.conn.execute('SELECT 1 FROM docs LIMIT 1').fetchone()
+
+    def update(self, nodes, prune=False):
+        """Index nodes not indexed since they last changed.
+
+        With prune, nodes are taken to be all there are and anything else
+        indexed is removed. Return number of documents added, updated or
+        removed.
+        """
+        indexed = dict((path, (doc_id, stamp)) for doc_id, path, stamp in
+                       self.conn.execute('SELECT id, path, stamp FROM docs'))
+        seen = set()
+        changed = []
+        for node in nodes:
+            path = node.openable_file
+            seen.add(path)
+            stamp = node_stamp(node)
+            if stamp is None:
+                continue
+            stamp = repr(stamp)  # a byte string, as text_factory returns it
+            if path not in indexed or indexed[path][1] != stamp:
+                changed.append((node, stamp))
+        removed = []
+        if prune:
+            removed = [path for path in indexed if path not in seen]
+        if not changed and not removed:
+            return 0
+
+        removals = defaultdict(set)  # word -> doc ids to take out
+        additions = defaultdict(list)  # word -> doc ids to put in
+        with self.conn:
+            for path in removed + [node.openable_file for node, _ in changed]:
+                if path in indexed:
+                    doc_id = indexed[path][0]
+                    doc_words, = self.conn.execute(
+                        'SELECT words FROM docs WHERE id = ?',
+                        (doc_id,)).fetchone()
+                    for word in doc_words.decode('utf-8').split():
+                        removals[word].add(doc_id)
+                    self.conn.execute('DELETE FROM docs WHERE id = ?',
+                                      (doc_id,))
+            for node, stamp in changed:
+                doc_words = words(node_text(node))
+                doc_id = self.conn.execute(
+                    'INSERT INTO docs (path, stamp, words) VALUES (?, ?, ?)',
+                    (node.openable_file, stamp,
+                     u' '.join(doc_words))).lastrowid
+                for word in doc_words:
+                    additions[word].append(doc_id)
+            self._update_postings(removals, additions)
+        return len(changed) + len(removed)
+
+    def _update_postings(self, removals, additions):
+        for word in sorted(set(removals) | set(additions)):
+            row = self.conn.execute('SELECT docs FROM postings WHERE word = ?',
+                                    (word,)).fetchone()
+            docs = array('i', str(row[0])) if row else array('i')
+            if word in removals:
+                docs = array('i', (doc_id for doc_id in docs
+                                   if doc_id not in removals[word]))
+            docs.extend(additions.get(word, ()))
+            if docs:
+                self.conn.execute('INSERT OR REPLACE INTO postings '
+                                  'VALUES (?, ?)',
+                                  (word, buffer(docs.tostring())))
+            elif row:
+                self.conn.execute('DELETE FROM postings WHERE word = ?',
+                                  (word,))
+
+    def _docs_starting(self, prefix):
+        """Return set of doc ids with a word starting prefix"""
+        # Those words run from prefix up to its successor
+        docs = set()
+        for row in self.conn.execute(
+                'SELECT docs FROM postings WHERE word >= ? AND word < ?',
+                (prefix, prefix[:-1] + unichr(ord(prefix[-1]) + 1))):
+            docs.update(array('i', str(row[0])))
+        return docs
+
+    def search(self, query):
+        """Return set of openable_files whose text matches every word of
+        query as a prefix"""
+        doc_ids = None
+        for prefix in sorted(words(query), key=len, reverse=True):
+            matches = self._docs_starting(prefix)
+            doc_ids = matches if doc_ids is None else doc_ids & matches
+            if not doc_ids:
+                return set()
+        if doc_ids is None:
+            return set()  # no words in query
+        doc_ids = list(doc_ids)
+        paths = set()
+        for i in xrange(0, len(doc_ids), _MAX_VARIABLES):
+            batch = doc_ids[i:i + _MAX_VARIABLES]
+            paths.update(path for path, in self.conn.execute(
+                'SELECT path FROM docs WHERE id IN (%s)' %
+                ', '.join('?' * len(batch)), batch))
+        return paths
+
+
+def open_index(wf):
+    """Return content index in the workflow cache dir"""
+    return ContentIndex.open(wf.cachefile(CONTENT_INDEX_FILE))
+
+
+def update(wf, nodes, prune=False):
+    """Bring content index in the workflow cache dir up to date with nodes"""
+    index = open_index(wf)
+    try:
+        changes = index.update(nodes, prune)
+        if changes:
+            logger.info('Content index: %i documents changed' % changes)
+    finally:
+        index.close()
+
+
+def update_and_search(wf, nodes, query, indexed=False):
+    """Return set of openable_files of nodes matching query, after bringing
+    the index up to date with nodes.
+
+    If indexed, the indexer keeps the index up to date, so it is only
+    searched, unless the indexer has yet to fill it.
+    """
+    index = open_index(wf)
+    try:
+        if not indexed or index.is_empty():
+            changes = index.update(nodes)
+            if changes:
+                logger.info('Content index: %i documents changed' % changes)
+        return index.search(query)
+    finally:
+        index.close()
@@ -0,0 +1,126 @@
+from os.path import join
+import codecs
+import errno
+import re
+from itertools import izip
+from multiprocessing.pool import ThreadPool
+
+import content_index
+import sheet_content
+
+
+"""Scan the text of sheets for query words, a chunk at a time.
+
+Used by content_search's 'scan' backend. A sheet's Text.txt (or, failing
+that, its Content.xml) is decoded and folded (see content_index.fold) in
+chunks, and reading stops as soon as every query word has been found as a
+word prefix, so a huge sheet is never held in memory and rarely read to
+the end. Sheets are scanned in tree order over a pool of threads, and the
+scan stops once as many matches as are to be shown have been found.
+
+"""
+
+
+CHUNK_SIZE = 64 * 1024
+
+# Characters of a word, including the combining marks content_index.fold
+# drops
+_WORD_CHARS = re.compile(u'[\\w\u0300-\u036f]*', re.UNICODE)
+
+
+def iter_text_file(path, chunk_size=CHUNK_SIZE, max_word=None):
+    """Yield text of file at path, decoded from UTF-8, in chunks that end
+    between words.
+
+    If max_word is given, longer words are cut short to their first
+    max_word characters once folded (see content_index.fold), so that text
+    with few breaks between words, such as CJK text, is still read a chunk
+    at a time. Words of up to max_word characters start a cut word only if
+    they start the whole of it.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    carry = u''  # unfinished last word of previous chunk
+    cutting = False  # skipping the rest of a word cut short
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            text = decoder.decode(data, final=not data)
+            if cutting:
+                skip = _WORD_CHARS.match(text).end()
+                cutting = skip == len(text)
+                text = text[skip:]
+            text = carry + text
+            if not data:
+                if text:
+                    yield text
+                return
+            # Hold back the word at the end, which may continue in the next
+            # chunk
+            split = len(text) - _WORD_CHARS.match(text[::-1]).end()
+            text, carry = text[:split], text[split:]
+            if max_word is not None and len(carry) > max_word:
+                word = content_index.fold(carry)
+                if len(word) > max_word:
+                    text, carry = text + word[:max_word], u''
+                    cutting = True
+            if text:
+                yield text
+
+
+def text_matches(chunks, prefixes):
+    """True if every one of prefixes starts a word in chunks of text.
+
+    Stops taking chunks once all have been found.
+    """
+    remaining = set(prefixes)
+    for text in chunks:
+        _remove_found(remaining, content_index.words(text))
+        if not remaining:
+            return True
+    return not remaining
+
+
+def text_file_matches(path, prefixes, chunk_size=CHUNK_SIZE):
+    """True if every one of prefixes starts a word in text file at path"""
+    max_word = max(len(prefix) for prefix in prefixes) if prefixes else 0
+    return text_matches(iter_text_file(path, chunk_size, max_word), prefixes)
+
+
+def _remove_found(remaining, text_words):
+    for prefix in list(remaining):
+        if any(word.startswith(prefix) for word in text_words):
+            remaining.discard(prefix)
+
+
+def sheet_matches(sheet, prefixes):
+    try:
+        return text_file_matches(join(sheet.dirpath, 'Text.txt'), prefixes)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    return text_matches(sheet_content.iter_text(sheet.dirpath), prefixes)
+
+
+def scan_sheets(sheets, query, threads, limit=0):
+    """Return sheets whose text matches query, up to limit of them if not 0.
+
+    Sheets are scanned in order. Those whose title alone matches come
+    first, the rest keeping their order.
+    """
+    prefixes = content_index.words(query)
+    if not prefixes:
+        return []
+    found = []
+    pool = ThreadPool(threads)
+    try:
+        matches = pool.imap(lambda sheet: sheet_matches(sheet, prefixes),
+                            sheets)
+        for sheet, matched in izip(sheets, matches):
+            if matched:
+                found.append(sheet)
+                if len(found) == limit:
+                    break
+    finally:
+        pool.terminate()  # drop sheets not scanned yet
+    return sorted(found, key=lambda sheet: not content_index.words_match(
+        prefixes, content_index.words(sheet.title)))
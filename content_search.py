@@ -0,0 +1,155 @@
+import workflow
+import logging
+
+import parse_ulysses
+import content_index
+import content_fts
+import content_scan
+
+
+"""Backends used by `uf` to filter groups and sheets on their content.
+
+Chosen by the --content-backend option of ulysses_items.py, else by the
+'content_backend' setting:
+
+- 'index' (default): content_index, kept in the workflow cache dir
+- 'fts': content_fts, an SQLite FTS5 database; results ranked by BM25.
+  Falls back to 'index' if this SQLite has no FTS5
+- 'scan': streams sheets' text on each search (see content_scan), stopping
+  once it has found as many matching sheets as --max-results asks for
+- 'mdfind': asks Spotlight
+
+All match as mdfind's '"query*"cdw' does, bar 'fts', which also matches
+Ulysses paths. 'index' and 'mdfind' keep tree order.
+
+"""
+
+
+DEFAULT_BACKEND = 'index'
+DEFAULT_SCAN_THREADS = 8
+
+
+logger = workflow.Workflow3().logger
+logger.setLevel(logging.DEBUG)
+
+
+class ContentBackend(object):  # consider abstract
+
+    name = 'override'
+
+    def filter(self, wf, groups, sheets, query, indexed=False,
+               max_results=0):
+        """Return (groups, sheets) whose content matches query.
+
+        indexed is true if the indexer is running, and so keeps any stored
+        index up to date through prepare; filter then only searches it.
+        max_results, if not 0, is the most of each kind the caller wants; a
+        backend may stop searching once it has found that many, but may
+        also return more.
+        """
+        raise NotImplementedError
+
+    def prepare(self, wf, nodes):
+        """Bring any stored index up to date, given every node there is.
+
+        Called by the indexer after each refresh.
+        """
+        pass
+
+
+class MdfindBackend(ContentBackend):
+
+    name = 'mdfind'
+
+    def filter(self, wf, groups, sheets, query, indexed=False,
+               max_results=0):
+        return parse_ulysses.filter_groups_and_sheets(groups, sheets, query)
+
+
+class ScanBackend(ContentBackend):
+
+    name = 'scan'
+
+    def filter(self, wf, groups, sheets, query, indexed=False,
+               max_results=0):
+        prefixes = content_index.words(query)
+        if not prefixes:
+            return [], []
+        # Groups are matched on their names, which are already in memory
+        groups = [group for group in groups if content_index.words_match(
+            prefixes, content_index.words(group.name))]
+        threads = wf.settings.get('content_scan_threads', DEFAULT_SCAN_THREADS)
+        # Matching groups do not count against the limit on sheets
+        return groups, content_scan.scan_sheets(sheets, query, threads,
+                                                max_results)
+
+
+class IndexBackend(ContentBackend):
+
+    name = 'index'
+
+    def filter(self, wf, groups, sheets, query, indexed=False,
+               max_results=0):
+        openable_files = content_index.update_and_search(
+            wf, groups + sheets, query, indexed)
+        return (parse_ulysses.filter_nodes_by_openable_file(groups,
+                                                            openable_files),
+                parse_ulysses.filter_nodes_by_openable_file(sheets,
+                                                            openable_files))
+
+    def prepare(self, wf, nodes):
+        content_index.update(wf, nodes, prune=True)
+
+
+class FtsBackend(ContentBackend):
+
+    name = 'fts'
+
+    def filter(self, wf, groups, sheets, query, indexed=False,
+               max_results=0):
+        if not content_fts.is_available():
+            return self.fallback().filter(wf, groups, sheets, query, indexed,
+                                          max_results)
+        ranked = content_fts.update_and_search(wf, groups + sheets, query,
+                                               indexed)
+        rank = dict((path, i) for i, path in enumerate(ranked))
+
+        def ranked_nodes(nodes):
+            found = []
+            for node in nodes:
+                i = rank.get(node.openable_file)
+                if i is not None:
+                    found.append((i, node))
+            found.sort()  # ranks are distinct, so nodes are never compared
+            return [node for _, node in found]
+        return ranked_nodes(groups), ranked_nodes(sheets)
+
+    def prepare(self, wf, nodes):
+        if not content_fts.is_available():
+            return self.fallback().prepare(wf, nodes)
+        conn = content_fts.connect(wf)
+        try:
+            content_fts.update(conn, nodes, prune=True)
+        finally:
+            conn.close()
+
+    @staticmethod
+    def fallback():
+        """Return backend used instead where SQLite has no FTS5; the
+        indexer prepares it in its place"""
+        return IndexBackend()
+
+
+BACKENDS = dict((backend.name, backend) for backend in
+                [MdfindBackend, ScanBackend, IndexBackend, FtsBackend])
+
+
+def get_backend(wf, name=None):
+    """Return backend called name, else the one in the 'content_backend'
+    setting. ValueError if there is no such backend."""
+    if name is None:
+        name = wf.settings.get('content_backend', DEFAULT_BACKEND)
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise ValueError("Unknown content backend '%s'" % name)
@@ -0,0 +1,536 @@
+from array import array
+from collections import defaultdict
+import hashlib
+import heapq
+import os
+import re
+import sqlite3
+import unicodedata
+from uuid import uuid4
+
+import fuzzy_batch
+from workflow.workflow import (MATCH_ALL, MATCH_STARTSWITH, MATCH_CAPITALS,
+                               MATCH_ATOM, MATCH_INITIALS_STARTSWITH,
+                               MATCH_INITIALS_CONTAIN, MATCH_SUBSTRING,
+                               MATCH_ALLCHARS, ASCII_REPLACEMENTS, INITIALS,
+                               isascii, split_on_delimiters)
+
+
+"""Fuzzy filtering of search keys prepared ahead of the query.
+
+Workflow.filter works out the folded and lower-cased value, its set of
+characters, capitals, atoms and initials for every item and query word on
+every call. A PreparedCorpus works these out once for a list of keys, and
+can be kept in the workflow cache dir between calls (see load_corpus), so
+each keystroke costs only the matching. It is saved without its keys, which
+the caller has anyway, and with only the parts of its prepared values that
+are slow to work out again, as a few long strings; so it loads far faster
+than a tuple per key would. The rest of a loaded key's prepared value is
+worked out only when the key is first scored. Scores, rules and order are
+the same as Workflow.filter's, except that items with the same score and
+key are left in corpus order.
+
+As the user types, each query usually extends the last. filter_in_session
+keeps the last query's matches in the session cache and then scores only
+those, as nothing else can match the longer query.
+
+A TrigramIndex, if kept with the corpus, narrows each query down to the
+keys that hold all of its words' trigrams before any are scored, when
+matching on every rule but MATCH_ALLCHARS. load_corpus saves it in an
+SQLite database of its own, from which a query reads only the postings of
+its own trigrams, so only the keys left are ever prepared and scored.
+
+With max_results, only the best so many matches are kept, in a heap, as
+the keys are scored, rather than every match being sorted.
+
+With batch, keys are scored by a fuzzy_batch.BatchScorer, rule by rule
+across all keys at once, rather than key by key, unless the index or the
+last query's matches have left only a few of them. The scorer is laid out
+afresh for each corpus loaded, but from the saved strings, without
+preparing keys one by one.
+
+"""
+
+
+# Bump whenever the shape of PreparedCorpus.state or of a saved
+# TrigramIndex changes
+FUZZY_CACHE_VERSION = 6
+
+# Between the strings a PreparedCorpus is saved as. Capitals and initials
+# hold only letters and digits.
+SEP = u'\n'
+
+# With batch, keys are still scored one by one if no more than this share
+# of them are candidates
+BATCH_MIN_SHARE = 0.5
+
+# Rules matching a query word only where it is found in the value (lower
+# case), capitals or initials, which TrigramIndex can narrow down
+INDEXED_RULES = (MATCH_STARTSWITH | MATCH_CAPITALS | MATCH_ATOM |
+                 MATCH_INITIALS_STARTSWITH | MATCH_INITIALS_CONTAIN |
+                 MATCH_SUBSTRING)
+
+
+def fold_to_ascii(text):
+    """As Workflow.fold_to_ascii"""
+    if isascii(text):
+        return text
+    text = ''.join([ASCII_REPLACEMENTS.get(c, c) for c in text])
+    return unicode(unicodedata.normalize('NFKD', text).encode('ascii',
+                                                               'ignore'))
+
+
+def prepare_value(value):
+    """Return what Workflow._filter_item matches a query word against.
+
+    A tuple of value, its lower case, set of characters, capitals (lower
+    case), atoms and initials.
+    """
+    lower = value.lower()
+    atoms = tuple(atom.lower() for atom in split_on_delimiters(value))
+    return (value, lower, frozenset(lower),
+            ''.join([c for c in value if c in INITIALS]).lower(),
+            atoms, ''.join([atom[0] for atom in atoms if atom]))
+
+
+def score_word(prepared, word, word_chars, match_on, search=None):
+    """Return (score, rule) for lower-case query word, as
+    Workflow._filter_item does for the value prepared by prepare_value"""
+    value, lower, chars, capitals, atoms, initials = prepared
+    if not word_chars <= chars:
+        return (0, None)
+    if match_on & MATCH_STARTSWITH and lower.startswith(word):
+        return (100.0 - (len(value) / len(word)), MATCH_STARTSWITH)
+    if match_on & MATCH_CAPITALS and capitals.startswith(word):
+        return (100.0 - (len(capitals) / len(word)), MATCH_CAPITALS)
+    if match_on & MATCH_ATOM and word in atoms:
+        return (100.0 - (len(value) / len(word)), MATCH_ATOM)
+    if match_on & MATCH_INITIALS_STARTSWITH and initials.startswith(word):
+        return (100.0 - (len(initials) / len(word)),
+                MATCH_INITIALS_STARTSWITH)
+    elif match_on & MATCH_INITIALS_CONTAIN and word in initials:
+        return (95.0 - (len(initials) / len(word)), MATCH_INITIALS_CONTAIN)
+    if match_on & MATCH_SUBSTRING and word in lower:
+        return (90.0 - (len(value) / len(word)), MATCH_SUBSTRING)
+    if match_on & MATCH_ALLCHARS:
+        match = search(value)
+        if match:
+            return (100.0 / ((1 + match.start()) *
+                             (match.end() - match.start() + 1)),
+                    MATCH_ALLCHARS)
+    return (0, None)
+
+
+def _allchars_search(word):
+    return re.compile(''.join(['.*?' + re.escape(c) for c in word]),
+                      re.IGNORECASE).search
+
+
+def word_grams(word):
+    """Return set of trigrams of word, or if it is shorter its characters"""
+    if len(word) < 3:
+        return set(word)
+    return set(word[j:j + 3] for j in xrange(len(word) - 2))
+
+
+class TrigramIndex(object):
+    """Index keys by the trigrams of their prepared values.
+
+    Keys are indexed by the characters of their lower-case value and the
+    trigrams of that value, their capitals and initials; so by everything a
+    query word is found in by INDEXED_RULES. Each gram's posting is an array
+    of key indexes in order, so candidates for a query are found from the
+    postings of its own grams, without a pass over every key.
+    """
+
+    def __init__(self, prepared_values):
+        postings = defaultdict(list)
+        for i, prepared in enumerate(prepared_values):
+            for gram in self._key_grams(prepared):
+                postings[gram].append(i)
+        self.postings = dict((gram, array('i', posting))
+                             for gram, posting in postings.iteritems())
+
+    @staticmethod
+    def _key_grams(prepared):
+        value, lower, chars, capitals, atoms, initials = prepared
+        grams = set(chars)
+        for text in (lower, capitals, initials):
+            grams.update(text[j:j + 3] for j in xrange(len(text) - 2))
+        return grams
+
+    def posting(self, gram):
+        """Return array of indexes of keys holding gram, or None"""
+        return self.postings.get(gram)
+
+    def candidates(self, words):
+        """Return list, in order, of indexes of keys which may match every
+        one of lower-case words by INDEXED_RULES"""
+        grams = set()
+        for word in words:
+            grams.update(word_grams(word))
+        postings = [self.posting(gram) for gram in grams]
+        if not all(postings):
+            return []
+        if len(postings) == 1:
+            return postings[0].tolist()
+        postings.sort(key=len)
+        found = set(postings[0])
+        for posting in postings[1:]:
+            found.intersection_update(posting)
+            if not found:
+                break
+        return sorted(found)
+
+    def save(self, path, token):
+        """Write index to an SQLite database at path, as that of the corpus
+        with given token, replacing any database there at once"""
+        temppath = '%s.%s' % (path, token)
+        conn = sqlite3.connect(temppath)
+        try:
+            with conn:
+                conn.execute('CREATE TABLE corpus (token TEXT)')
+                conn.execute('INSERT INTO corpus VALUES (?)', (token,))
+                conn.execute('CREATE TABLE postings (gram TEXT PRIMARY KEY, '
+                             'posting BLOB) WITHOUT ROWID')
+                conn.executemany('INSERT INTO postings VALUES (?, ?)', (
+                    (gram, buffer(posting.tostring()))
+                    for gram, posting in self.postings.iteritems()))
+        finally:
+            conn.close()
+        os.rename(temppath, path)
+
+
+class SavedTrigramIndex(TrigramIndex):
+    """A TrigramIndex written by TrigramIndex.save, whose postings are read
+    from the database one at a time, as queries need them"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    @classmethod
+    def open(cls, path, token):
+        """Return index saved at path for the corpus with given token, or
+        None if there is none"""
+        if not os.path.exists(path):
+            return None
+        conn = sqlite3.connect(path)
+        try:
+            saved = conn.execute('SELECT token FROM corpus').fetchone()
+        except sqlite3.DatabaseError:
+            saved = None
+        if saved is None or saved[0] != token:
+            conn.close()
+            return None
+        return cls(conn)
+
+    def posting(self, gram):
+        row = self.conn.execute('SELECT posting FROM postings WHERE gram = ?',
+                                (gram,)).fetchone()
+        return array('i', str(row[0])) if row else None
+
+
+class PreparedCorpus(object):
+    """Search keys prepared for fuzzy filtering, in the order given.
+
+    With index true a TrigramIndex of the keys is built too.
+    """
+
+    def __init__(self, keys, index=False):
+        self.token = uuid4().hex  # tells session caches which corpus
+        self.keys = list(keys)
+        self.values = [key.strip() for key in self.keys]
+        # Values folded to ASCII, by index, of those that are not ASCII
+        self.folds = dict((i, fold_to_ascii(value))
+                          for i, value in enumerate(self.values)
+                          if not isascii(value))
+        self._folded = [prepare_value(self.folds.get(i, value))
+                        for i, value in enumerate(self.values)]
+        self._parts = None  # what _folded is worked out from, if not yet
+        self._unfolded = None
+        self.index = TrigramIndex(self._folded) if index else None
+
+    def state(self):
+        """Return dict of a digest of the keys, and the parts of folded that
+        are slow to work out again, as long strings; see from_state.
+
+        A TrigramIndex is not part of it; see TrigramIndex.save.
+        """
+        return {'token': self.token,
+                'digest': keys_digest(self.keys),
+                'folds': self.folds,
+                'capitals': SEP.join([p[3] for p in self.folded]),
+                'initials': SEP.join([p[5] for p in self.folded]),
+                'index': self.index is not None}
+
+    @classmethod
+    def from_state(cls, state, keys):
+        """Return corpus for keys saved as state, or None if it was saved
+        for other keys. Any index is for the caller to open; see
+        SavedTrigramIndex."""
+        if keys_digest(keys) != state['digest']:
+            return None
+        self = cls.__new__(cls)
+        self.token = state['token']
+        self.keys = list(keys)
+        self.values = [key.strip() for key in self.keys]
+        self.folds = state['folds']
+        folded_values = list(self.values)
+        for i, value in self.folds.iteritems():
+            folded_values[i] = value
+        self._folded = [None] * len(self.values)
+        self._parts = (folded_values, state['capitals'].split(SEP),
+                       state['initials'].split(SEP))
+        self._unfolded = None
+        self.index = None
+        return self
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def folded(self):
+        """Prepared values (see prepare_value) of keys folded to ASCII"""
+        self._prepare()
+        return self._folded
+
+    def columns(self):
+        """Return lists of the values folded to ASCII, their capitals and
+        their initials, without preparing keys that are not yet"""
+        if self._parts is not None:
+            return self._parts
+        return ([p[0] for p in self._folded], [p[3] for p in self._folded],
+                [p[5] for p in self._folded])
+
+    def _prepare(self, indexes=None):
+        """Work out the prepared values of keys at indexes, or of every key,
+        if not yet done"""
+        if self._parts is None:
+            return
+        folded_values, capitals, initials = self._parts
+        # All at once is quicker if most keys are wanted
+        if indexes is None or len(indexes) > len(folded_values) // 2:
+            lowers = [value.lower() for value in folded_values]
+            self._folded = zip(folded_values, lowers, map(frozenset, lowers),
+                               capitals,
+                               [tuple(split_on_delimiters(lower))
+                                for lower in lowers],
+                               initials)
+            self._parts = None
+            return
+        folded = self._folded
+        for i in indexes:
+            if folded[i] is None:
+                lower = folded_values[i].lower()
+                folded[i] = (folded_values[i], lower, frozenset(lower),
+                             capitals[i], tuple(split_on_delimiters(lower)),
+                             initials[i])
+
+    @property
+    def unfolded(self):
+        """Prepared values as they are, for queries with non-ASCII words;
+        None where the same as folded. Worked out when first needed."""
+        if self._unfolded is None:
+            self._unfolded = [None] * len(self.values)
+            for i in self.folds:
+                self._unfolded[i] = prepare_value(self.values[i])
+        return self._unfolded
+
+    def filter(self, query, ascending=False, min_score=0, max_results=0,
+               match_on=MATCH_ALL, fold_diacritics=True, candidates=None,
+               survivors=None, batch=False):
+        """Return list of (index, score, rule) of keys matching query.
+
+        Arguments as for Workflow.filter, which this matches. If candidates
+        is given, only keys at those indexes are scored, less any the
+        corpus's index rules out. If survivors is a list, the index of every
+        key that some rule matched for each word is added to it; as for
+        Workflow.filter, keys whose score comes to nothing are not returned,
+        but may still match a longer query. With max_results, the best that
+        many are picked out as keys are scored, in a heap of that size.
+        Only keys scored are prepared, if the corpus was loaded by
+        from_state. With batch, the keys (or candidates) left are scored at
+        once by a fuzzy_batch.BatchScorer, unless the keys or query hold its
+        separators, or no more than BATCH_MIN_SHARE of them are left.
+        """
+        if not query:
+            raise ValueError('Empty `query`')
+        query = query.strip()
+        if not query:
+            raise ValueError('`query` contains only whitespace')
+        words = [word.strip().lower() for word in query.split(' ')]
+        words = [word for word in words if word]
+
+        # Work out all that depends only on the query once
+        tests = []
+        for word in words:
+            fold = fold_diacritics and isascii(word)
+            search = (_allchars_search(word) if match_on & MATCH_ALLCHARS
+                      else None)
+            tests.append((word, frozenset(word), fold, search))
+
+        # The index holds folded values, so is no use if any word is matched
+        # against values as they are
+        if (self.index is not None and not match_on & ~INDEXED_RULES and
+                all(fold for _, _, fold, _ in tests)):
+            indexed = self.index.candidates(words)
+            if candidates is None:
+                # Left as None if every key is a candidate, which is
+                # quicker to score
+                if len(indexed) < len(self):
+                    candidates = indexed
+            else:
+                indexed = set(indexed)
+                candidates = [i for i in candidates if i in indexed]
+
+        # Scoring the keys left one by one is quicker if there are few
+        if (batch and (candidates is None or
+                       len(candidates) > BATCH_MIN_SHARE * len(self)) and
+                self._batch_scorer().usable(tests)):
+            matches = self._batch_matches(tests, match_on, candidates,
+                                          min_score, survivors)
+            return self._best(matches, ascending, max_results)
+
+        self._prepare(candidates)
+        if candidates is None:
+            candidates = xrange(len(self.values))
+        matches = self._matches(tests, match_on, candidates, min_score,
+                                survivors)
+        return self._best(matches, ascending, max_results)
+
+    @staticmethod
+    def _best(matches, ascending, max_results):
+        if not max_results:
+            results = sorted(matches, reverse=ascending)
+        elif ascending:
+            results = heapq.nlargest(max_results, matches)
+        else:
+            results = heapq.nsmallest(max_results, matches)
+        return [t[1] for t in results]
+
+    def _matches(self, tests, match_on, candidates, min_score, survivors):
+        """Yield (sort key, (index, score, rule)) for each of candidates
+        matching every test with a score above min_score"""
+        folded = self._folded
+        for i in candidates:
+            value = self.values[i]
+            if value == '':
+                continue
+            skip = False
+            score = 0
+            rule = None
+            for word, word_chars, fold, search in tests:
+                prepared = folded[i]
+                if not fold and self.unfolded[i] is not None:
+                    prepared = self.unfolded[i]
+                s, rule = score_word(prepared, word, word_chars, match_on,
+                                     search)
+                if rule is None:
+                    break
+                if not s:
+                    skip = True
+                score += s
+            if rule is None:
+                continue
+            if survivors is not None:
+                survivors.append(i)
+            if skip or not score or (min_score and score <= min_score):
+                continue
+            yield ((100.0 / score, value.lower(), score, i),
+                   (i, score, rule))
+
+    def _batch_scorer(self):
+        # Built when first needed, so not kept in the workflow cache dir
+        if getattr(self, '_batch', None) is None:
+            self._batch = fuzzy_batch.BatchScorer(self)
+        return self._batch
+
+    def _batch_matches(self, tests, match_on, candidates, min_score,
+                       survivors):
+        """As _matches, scoring with the batch scorer"""
+        matched, results = self._batch_scorer().matches(tests, match_on,
+                                                        candidates)
+        if survivors is not None:
+            survivors.extend(matched)
+        for i, score, rule in results:
+            if not min_score or score > min_score:
+                yield ((100.0 / score, self.values[i].lower(), score, i),
+                       (i, score, rule))
+
+
+def keys_digest(keys):
+    """Return MD5 digest of keys, told apart by their lengths"""
+    digest = hashlib.md5(SEP.join(keys).encode('utf-8'))
+    digest.update(array('i', map(len, keys)).tostring())
+    return digest.hexdigest()
+
+
+def query_words(query):
+    return [word for word in query.strip().lower().split(' ') if word]
+
+
+def extends(query, previous_query):
+    """True if every key matching query also matches previous_query.
+
+    So when each of previous_query's words starts the word in the same
+    place in query, which may have more words. A key matching a word by
+    any rule matches its prefixes too, if need be as a substring, so this
+    holds as long as MATCH_SUBSTRING is in use.
+    """
+    words = query_words(query)
+    previous_words = query_words(previous_query)
+    return (len(words) >= len(previous_words) and
+            all(word.startswith(previous_word) for word, previous_word
+                in zip(words, previous_words)))
+
+
+def filter_in_session(wf, name, corpus, query, match_on=MATCH_ALL,
+                      fold_diacritics=True, max_results=0, batch=False):
+    """Return corpus.filter(query, ...), reusing the last call's matches.
+
+    If the last call this session, under the same name, was for the same
+    corpus and options and a query that query extends, only the keys it
+    matched are scored. The matches (including any scored nothing) are
+    then kept for the next call.
+    """
+    cache_name = 'fuzzy-refine-' + name
+    options = (corpus.token, match_on, fold_diacritics)
+    candidates = None
+    previous = wf.cached_data(cache_name, max_age=0, session=True)
+    if (previous and previous['options'] == options and
+            match_on & MATCH_SUBSTRING and
+            extends(query, previous['query'])):
+        candidates = previous['matches']
+    matches = []
+    results = corpus.filter(query, max_results=max_results, match_on=match_on,
+                            fold_diacritics=fold_diacritics,
+                            candidates=candidates, survivors=matches,
+                            batch=batch)
+    wf.cache_data(cache_name,
+                  {'options': options, 'query': query, 'matches': matches},
+                  session=True)
+    return results
+
+
+def load_corpus(wf, name, keys, index=False):
+    """Return PreparedCorpus for keys, from the workflow cache dir if one was
+    saved there under name for the same keys and index option, else prepared
+    and saved"""
+    cache_name = 'fuzzy-' + name
+    index_file = wf.cachefile(cache_name + '-index.sqlite')
+    cached = wf.cached_data(cache_name, max_age=0)
+    if (cached and cached['version'] == FUZZY_CACHE_VERSION and
+            cached['corpus']['index'] == index):
+        corpus = PreparedCorpus.from_state(cached['corpus'], keys)
+        if corpus is not None and index:
+            corpus.index = SavedTrigramIndex.open(index_file, corpus.token)
+            if corpus.index is None:
+                corpus = None
+        if corpus is not None:
+            return corpus
+    corpus = PreparedCorpus(keys, index)
+    if index:
+        corpus.index.save(index_file, corpus.token)
+    wf.cache_data(cache_name, {'version': FUZZY_CACHE_VERSION,
+                               'corpus': corpus.state()})
+    return corpus
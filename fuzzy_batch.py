@@ -0,0 +1,321 @@
+from bisect import bisect_right
+from itertools import izip
+import re
+import string
+
+from workflow.workflow import (MATCH_STARTSWITH, MATCH_CAPITALS, MATCH_ATOM,
+                               MATCH_INITIALS_STARTSWITH,
+                               MATCH_INITIALS_CONTAIN, MATCH_SUBSTRING,
+                               MATCH_ALLCHARS)
+
+numpy = None  # set by import_numpy
+_numpy_imported = False
+
+
+"""Score query words against all keys of a fuzzy.PreparedCorpus at once.
+
+PreparedCorpus.filter tries the rules one key at a time. A BatchScorer
+joins each of the keys' lower-case values, capitals, initials, atoms and
+values into one text, a key to a line, so a rule is tried against every key
+by a single regular expression search, and the offsets of the matches are
+mapped back to keys. Each key takes the score of the first rule, in
+Workflow._filter_item's order, to match it, so scores and rules are those
+fuzzy.score_word gives.
+
+The texts are laid out from the corpus's values, capitals and initials
+(see PreparedCorpus.columns) by a few operations on whole texts, so the
+keys need not be prepared one by one. Scores are worked out over arrays
+with NumPy if it can be imported, else key by key over the matches in
+Python. NumPy is imported by the first BatchScorer, so that filtering key
+by key never pays for it. The texts for matching against values as they
+are, rather than folded to ASCII, are laid out only for the first query
+that needs them.
+
+"""
+
+
+SEP = u'\n'  # between keys; MATCH_ALLCHARS patterns stop at it
+ATOM_SEP = u'\x01'  # between atoms of a key
+
+# What split_on_delimiters splits values at, bar SEP, as a pattern and, for
+# ASCII text, a table for str.translate
+_DELIMITER = re.compile(u'[^a-zA-Z0-9%s]' % SEP)
+_ATOM_SEPS = ''.join([
+    c if c in string.ascii_letters + string.digits + str(SEP)
+    else str(ATOM_SEP) for c in map(chr, xrange(256))])
+
+# In the order Workflow._filter_item tries them
+RULES = (MATCH_STARTSWITH, MATCH_CAPITALS, MATCH_ATOM,
+         MATCH_INITIALS_STARTSWITH, MATCH_INITIALS_CONTAIN, MATCH_SUBSTRING,
+         MATCH_ALLCHARS)
+
+# Score of a word matched by rule is this less length scored / word length
+BASE_SCORES = {MATCH_INITIALS_CONTAIN: 95.0, MATCH_SUBSTRING: 90.0}
+
+
+def import_numpy():
+    """Return numpy, imported when first asked for, or None if it is not
+    installed"""
+    global numpy, _numpy_imported
+    if not _numpy_imported:
+        _numpy_imported = True
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+    return numpy
+
+
+class _Column(object):
+    """Strings joined into a text, each between separators"""
+
+    def __init__(self, strings):
+        self.text = SEP + SEP.join(strings) + SEP
+        self.lengths = map(len, strings)
+        if numpy is not None:
+            self.lengths = numpy.array(self.lengths, dtype=int)
+            # Offset of each string in text
+            self.starts = numpy.cumsum(self.lengths + 1) - self.lengths
+        else:
+            self.starts = []
+            start = 1
+            for length in self.lengths:
+                self.starts.append(start)
+                start += length + 1
+
+    def derived(self, text):
+        """Return column of text laid out as this one, e.g. its lower case,
+        which must be as long"""
+        column = _Column.__new__(_Column)
+        column.text = text
+        column.lengths = self.lengths
+        column.starts = self.starts
+        return column
+
+    def keys(self, ends):
+        """Return indexes of the strings holding the characters before each
+        offset in ends"""
+        if numpy is not None:
+            ends = numpy.array(ends, dtype=int)
+            return numpy.searchsorted(self.starts, ends, 'right') - 1
+        return [bisect_right(self.starts, end) - 1 for end in ends]
+
+    def finditer(self, pattern):
+        return pattern.finditer(self.text)
+
+
+class _View(object):
+    """Values, with their capitals and initials as fuzzy.prepare_value works
+    them out, laid out for searching"""
+
+    def __init__(self, values, capitals, initials):
+        self.values = _Column(values)
+        text = self.values.text
+        self.usable = (text.count(SEP) == len(values) + 1 and
+                       ATOM_SEP not in text)
+        if not self.usable:
+            return
+        # unicode.lower and _DELIMITER keep each character to one, so the
+        # lower-case values and atoms are laid out as the values are
+        self.lowers = self.values.derived(text.lower())
+        self._has_char = {}  # whether lowers hold a character, by character
+        self.capitals = _Column(capitals)
+        self.atoms = self.values.derived(_atoms_text(self.values.text))
+        self.initials = _Column(initials)
+        self.lengths = {'value': self.values.lengths,
+                        'capitals': self.capitals.lengths,
+                        'initials': self.initials.lengths}
+
+    def hits(self, word, word_chars, rule, pending):
+        """Return (keys, lengths) for matches of lower-case word by rule.
+
+        lengths are those scored by rule, for every key, or for
+        MATCH_ALLCHARS the length + 1 of each key's match, which starts
+        the value.
+        MATCH_ALLCHARS, tried last, is tried only on the keys in pending.
+        """
+        if not all(self._has(c) for c in word_chars):
+            return [], []
+        # Each pattern takes the rest of the line after a match, so finds a
+        # key at most once
+        escaped = re.escape(word)
+        if rule == MATCH_STARTSWITH:
+            return (self._keys(self.lowers, SEP + escaped),
+                    self.lengths['value'])
+        if rule == MATCH_CAPITALS:
+            return (self._keys(self.capitals, SEP + escaped),
+                    self.lengths['capitals'])
+        if rule == MATCH_ATOM:
+            return (self._keys(self.atoms, u'[%s%s]%s(?=[%s%s])' % (
+                SEP, ATOM_SEP, escaped, SEP, ATOM_SEP)),
+                    self.lengths['value'])
+        if rule == MATCH_INITIALS_STARTSWITH:
+            return (self._keys(self.initials, SEP + escaped),
+                    self.lengths['initials'])
+        if rule == MATCH_INITIALS_CONTAIN:
+            return self._keys(self.initials, escaped), self.lengths['initials']
+        if rule == MATCH_SUBSTRING:
+            return self._keys(self.lowers, escaped), self.lengths['value']
+        # MATCH_ALLCHARS: '.*?a.*?b' matches from the start of a value if at
+        # all, taking the first of each character in turn, as '[^a]*a[^b]*b'
+        # does without backtracking. Few keys are usually left by now, so
+        # they are tried one by one.
+        match = _allchars_pattern(word).match
+        keys = []
+        lengths = []
+        for key in pending:
+            found = match(self.values.text, self.values.starts[key])
+            if found:
+                keys.append(key)
+                lengths.append(found.end() - found.start() + 1)
+        return keys, lengths
+
+    def _has(self, char):
+        if char not in self._has_char:
+            self._has_char[char] = char in self.lowers.text
+        return self._has_char[char]
+
+    def _keys(self, column, regex):
+        return column.keys([match.end() - 1 for match in column.finditer(
+            re.compile(regex + u'[^%s]*' % SEP))])
+
+
+def _atoms_text(text):
+    """Return text in lower case, with the delimiters split_on_delimiters
+    splits at, bar SEP, made ATOM_SEP"""
+    try:
+        # Far quicker for the values folded to ASCII
+        return text.encode('ascii').translate(_ATOM_SEPS).lower().decode(
+            'ascii')
+    except UnicodeEncodeError:
+        return _DELIMITER.sub(ATOM_SEP, text).lower()
+
+
+def _allchars_pattern(word):
+    return re.compile(u''.join([u'[^%s%s]*%s' % (SEP, re.escape(c),
+                                                 re.escape(c))
+                                for c in word]), re.IGNORECASE)
+
+
+def _score(rule, word, lengths):
+    """Return score for word by rule given the length scored"""
+    if rule == MATCH_ALLCHARS:
+        return 100.0 / lengths
+    return BASE_SCORES.get(rule, 100.0) - lengths // len(word)
+
+
+class BatchScorer(object):
+    """A PreparedCorpus's keys laid out for scoring all at once"""
+
+    def __init__(self, corpus):
+        import_numpy()
+        self.corpus = corpus
+        self.size = len(corpus)
+        # Keys with empty values need no leaving out, as no rule matches
+        # them
+        self.folded = _View(*corpus.columns())
+        self._unfolded = None
+
+    @property
+    def unfolded(self):
+        if self._unfolded is None:
+            values, capitals, initials = map(list, self.corpus.columns())
+            for i, prepared in enumerate(self.corpus.unfolded):
+                if prepared is not None:
+                    values[i] = prepared[0]
+                    capitals[i] = prepared[3]
+                    initials[i] = prepared[5]
+            self._unfolded = _View(values, capitals, initials)
+        return self._unfolded
+
+    def usable(self, tests):
+        """False if any value or query word holds a separator, so cannot be
+        searched for in the joined texts.
+
+        tests are as for matches; values as they are, rather than folded,
+        are looked at only if some word is to be matched against them.
+        """
+        if any(SEP in word or ATOM_SEP in word for word, _, _, _ in tests):
+            return False
+        if not all(fold for _, _, fold, _ in tests):
+            return self.folded.usable and self.unfolded.usable
+        return self.folded.usable
+
+    def matches(self, tests, match_on, candidates=None):
+        """Return (survivors, results) as PreparedCorpus.filter works out.
+
+        tests are its (word, word_chars, fold, search) for each query word.
+        survivors are the indexes, in order, of keys that some rule matched
+        for each word, and results the (index, score, rule) of those whose
+        score came to something, rule being the last word's.
+        """
+        if numpy is not None:
+            return self._numpy_matches(tests, match_on, candidates)
+        return self._python_matches(tests, match_on, candidates)
+
+    def _numpy_matches(self, tests, match_on, candidates):
+        alive = numpy.ones(self.size, dtype=bool)
+        if candidates is not None:
+            alive[:] = False
+            alive[numpy.array(list(candidates), dtype=int)] = True
+        total = numpy.zeros(self.size)
+        scored_nothing = numpy.zeros(self.size, dtype=bool)
+        for word, word_chars, fold, _ in tests:
+            view = self.folded if fold else self.unfolded
+            rules = numpy.zeros(self.size, dtype=numpy.int8)
+            scores = numpy.zeros(self.size)
+            for rule in RULES:
+                if not match_on & rule:
+                    continue
+                pending = None
+                if rule == MATCH_ALLCHARS:
+                    pending = numpy.flatnonzero(alive & (rules == 0)).tolist()
+                keys, lengths = view.hits(word, word_chars, rule, pending)
+                keys = numpy.array(keys, dtype=int)
+                lengths = numpy.asarray(lengths)
+                if rule != MATCH_ALLCHARS:
+                    lengths = lengths[keys]
+                new = alive[keys] & (rules[keys] == 0)
+                keys = keys[new]
+                rules[keys] = rule
+                scores[keys] = _score(rule, word, lengths[new])
+            alive &= rules != 0
+            scored_nothing |= scores == 0
+            total += scores
+        survivors = numpy.flatnonzero(alive)
+        results = [(i, score, rule) for i, score, rule in izip(
+            survivors.tolist(), total[survivors].tolist(),
+            rules[survivors].tolist()) if score and not scored_nothing[i]]
+        return survivors.tolist(), results
+
+    def _python_matches(self, tests, match_on, candidates):
+        if candidates is None:
+            candidates = xrange(self.size)
+        alive = set(candidates)
+        total = dict.fromkeys(alive, 0)
+        scored_nothing = set()
+        for word, word_chars, fold, _ in tests:
+            view = self.folded if fold else self.unfolded
+            rules = {}
+            scores = {}
+            for rule in RULES:
+                if not match_on & rule:
+                    continue
+                pending = None
+                if rule == MATCH_ALLCHARS:
+                    pending = [key for key in alive if key not in rules]
+                keys, lengths = view.hits(word, word_chars, rule, pending)
+                for j, key in enumerate(keys):
+                    if key in alive and key not in rules:
+                        rules[key] = rule
+                        scores[key] = _score(rule, word, lengths[
+                            j if rule == MATCH_ALLCHARS else key])
+            alive.intersection_update(rules)
+            for key in alive:
+                if not scores[key]:
+                    scored_nothing.add(key)
+                total[key] += scores[key]
+        survivors = sorted(alive)
+        results = [(i, total[i], rules[i]) for i in survivors
+                   if total[i] and i not in scored_nothing]
+        return survivors, results
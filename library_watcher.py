@@ -0,0 +1,241 @@
+import os
+from os.path import join
+import ctypes
+import ctypes.util
+import errno
+import select
+import struct
+import time
+
+import workflow
+import logging
+
+import parse_ulysses
+
+
+"""Report directories in Ulysses libraries that have changed.
+
+Uses inotify where available (Linux) and falls back to polling elsewhere,
+comparing the stamps parse_ulysses records: the mtimes of sheets' text
+files and groups' Info.ulgroup, which Ulysses rewrites in place, as well
+as of group directories. Either way, bursts of changes (e.g. from iCloud
+sync) are debounced and reported together as a set of changed directory
+paths. A change to a sheet is reported as its .ulysses package directory,
+and a sheet or group being added, renamed or removed as its parent
+group's. If inotify's queue overflows, the changes in it are lost, so the
+root directories are reported; a reported root means anything under it
+may have changed.
+
+"""
+
+
+DEFAULT_DEBOUNCE = 1.0  # seconds of quiet before changes are reported
+MAX_DEBOUNCE_DELAY = 10.0  # report changes after this long regardless
+
+
+logger = workflow.Workflow3().logger
+logger.setLevel(logging.DEBUG)
+
+
+def create_watcher(rootdirs, debounce=DEFAULT_DEBOUNCE):
+    """Return watcher for rootdirs, using inotify if possible"""
+    try:
+        return InotifyWatcher(rootdirs, debounce)
+    except (OSError, AttributeError) as e:
+        logger.info('inotify unavailable (%s); polling for changes' % e)
+        return PollingWatcher(rootdirs, debounce)
+
+
+def library_dirs(rootgroupdir):
+    """Yield every group and sheet directory in a library tree"""
+    yield rootgroupdir
+    try:
+        filelist = os.listdir(rootgroupdir)
+    except OSError:
+        return  # removed since its parent was listed
+    for name in filelist:
+        path = join(rootgroupdir, name)
+        if name.endswith('.ulysses'):
+            yield path
+        elif name.endswith('-ulgroup'):
+            for dirpath in library_dirs(path):
+                yield dirpath
+
+
+class Watcher(object):  # consider abstract
+
+    def __init__(self, rootdirs, debounce):
+        self.rootdirs = list(rootdirs)
+        self.debounce = debounce
+
+    def wait_for_changes(self, timeout):
+        """Return set of changed directories, or empty set after timeout.
+
+        Once a change is seen, keep collecting until there has been no
+        change for the debounce period, or MAX_DEBOUNCE_DELAY has passed.
+        """
+        changed = self._read_changes(timeout)
+        if not changed:
+            return changed
+        deadline = time.time() + MAX_DEBOUNCE_DELAY
+        while time.time() < deadline:
+            more = self._read_changes(self.debounce)
+            if not more:
+                break
+            changed |= more
+        return changed
+
+    def _read_changes(self, timeout):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class PollingWatcher(Watcher):
+    """Watch by stamping every group and sheet on each poll.
+
+    A group is only re-listed when its directory mtime has changed, so a
+    poll of an unchanged library costs a few stats per group and one or two
+    per sheet. That is still a pass over the whole library each time.
+    """
+
+    def __init__(self, rootdirs, debounce):
+        Watcher.__init__(self, rootdirs, debounce)
+        self._listings = {}  # groupdir -> (directory mtime, listing)
+        self._stamps = self._scan()
+
+    def _scan(self):
+        stamps = {}
+        listings = {}
+        for rootdir in self.rootdirs:
+            groupdirs = [rootdir]
+            while groupdirs:
+                groupdir = groupdirs.pop()
+                try:
+                    stamp = parse_ulysses.group_stamp(groupdir)
+                    previous = self._listings.get(groupdir)
+                    if previous and previous[0] == stamp[0]:
+                        filelist = previous[1]
+                    else:
+                        filelist = os.listdir(groupdir)
+                except OSError:
+                    continue  # removed, or not yet complete; seen next time
+                stamps[groupdir] = stamp
+                listings[groupdir] = (stamp[0], filelist)
+                for name in filelist:
+                    path = join(groupdir, name)
+                    if name.endswith('.ulysses'):
+                        try:
+                            stamps[path] = parse_ulysses.sheet_stamp(path)
+                        except OSError:
+                            pass
+                    elif name.endswith('-ulgroup'):
+                        groupdirs.append(path)
+        self._listings = listings
+        return stamps
+
+    def _read_changes(self, timeout):
+        time.sleep(timeout)
+        stamps = self._scan()
+        # Removed directories show up as a change to their parent's stamp
+        changed = set(dirpath for dirpath, stamp in stamps.iteritems()
+                      if self._stamps.get(dirpath) != stamp)
+        self._stamps = stamps
+        return changed
+
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE)
+
+_EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+class InotifyWatcher(Watcher):
+
+    def __init__(self, rootdirs, debounce):
+        Watcher.__init__(self, rootdirs, debounce)
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                 use_errno=True)
+        self._fd = self._libc.inotify_init()
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        self._paths_by_wd = {}
+        try:
+            for rootdir in self.rootdirs:
+                self._add_watches(rootdir)
+        except OSError:
+            self.close()
+            raise
+
+    def _add_watches(self, dirpath):
+        for path in library_dirs(dirpath):
+            wd = self._libc.inotify_add_watch(self._fd, path, WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err == errno.ENOENT:
+                    continue  # removed since listed
+                # ENOSPC means fs.inotify.max_user_watches is too low
+                raise OSError(err, "inotify_add_watch failed for '%s'" % path)
+            self._paths_by_wd[wd] = path
+
+    def _read_changes(self, timeout):
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+        return self._changes_from_events(os.read(self._fd, 64 * 1024))
+
+    def _changes_from_events(self, data):
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped, so directories added since may be
+                # unwatched as well as their changes lost
+                logger.warn('inotify queue overflowed; rescanning libraries')
+                changed.update(self.rootdirs)
+                for rootdir in self.rootdirs:
+                    try:
+                        self._add_watches(rootdir)
+                    except OSError as e:
+                        logger.warn("Could not watch '%s': %s" % (rootdir, e))
+                continue
+            if mask & IN_IGNORED:
+                self._paths_by_wd.pop(wd, None)
+                continue
+            dirpath = self._paths_by_wd.get(wd)
+            if dirpath is None:
+                continue
+            changed.add(dirpath)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # A directory moved within the library keeps its watch, which
+                # is remapped to the new path here
+                new_dirpath = join(dirpath, name)
+                if new_dirpath.endswith(('-ulgroup', '.ulysses')):
+                    try:
+                        self._add_watches(new_dirpath)
+                    except OSError as e:
+                        logger.warn("Could not watch '%s': %s"
+                                    % (new_dirpath, e))
+        return changed
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
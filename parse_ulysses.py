@@ -1,6 +1,11 @@
 import os
 from os.path import join
+import copy
+import errno
+import hashlib
 import subprocess
+from collections import Counter, deque
+from multiprocessing.pool import ThreadPool
 import biplist  # the built in plistlib does not support binary plist files.
 
 from pyexpat import ExpatError
@@ -8,6 +13,8 @@ from pyexpat import ExpatError
 import workflow
 import logging
 
+import sheet_content
+
 # SHEET = "com.soulmen.ulysses3.sheet"
 # GROUP = "com.soulmen.ulysses3.group"
 
@@ -22,37 +29,103 @@ ULYSSES3_LOCAL_LIB = join(os.environ['HOME'], 'Library', 'Containers',
 LOCAL_GROUPS_ROOT = join(ULYSSES3_LOCAL_LIB, 'Groups-ulgroup')
 LOCAL_UNFILED_ROOT = join(ULYSSES3_LOCAL_LIB, 'Unfiled-ulgroup')  # a.k.a. Inbox
 
+LIBRARY_ROOTS = [ICLOUD_GROUPS_ROOT, ICLOUD_UNFILED_ROOT,
+                 LOCAL_GROUPS_ROOT, LOCAL_UNFILED_ROOT]
+
 
 MDFIND_SHEET_QUERY = '((** = "%s*"cdw) && (kMDItemKind = "Ulysses Sheet*"cdwt))'
 MDFIND_GROUP_QUERY = '((** = "%s*"cdw) && (kMDItemKind = "Ulysses Group*"cdwt))'
 
+DEFAULT_TREE_BUILDER_THREADS = 8
+
+# Traversal orders for iter_groups
+PRE_ORDER = 'pre'
+POST_ORDER = 'post'
+BREADTH_FIRST = 'breadth'
+
+# Bump whenever the pickled shape of Group or Sheet, or how they are read,
+# changes. It is part of the snapshot's cache name, as a snapshot pickled
+# with other __slots__ cannot even be unpickled.
+TREE_CACHE_VERSION = 11
+
+# Internal name of a library's top group, left out of Ulysses paths
+MAIN_GROUP_NAME = 'Main'
+
 
 logger = workflow.Workflow3().logger
 logger.setLevel(logging.DEBUG)
 
-class Node:  # consider abstract
+class Node(object):  # consider abstract
+    """Group or sheet in a tree.
+
+    Nodes have __slots__ and store only their own directory name, so the
+    long library path prefix is held once, by the root group. dirpath and
+    openable_file are computed from the chain of parent groups when asked
+    for. Ancestors and Ulysses paths are held by groups, set by store_paths
+    when a tree is built, and shared by the nodes inside them.
+    """
+    __slots__ = ('_dirname', 'parent_group', 'stamp')
+
     is_group = 'override'
     is_sheet = 'override'
 
     def __init__(self, dirpath, parent_group):
-        self.dirpath = dirpath
+        if parent_group is None:
+            self._dirname = _intern(dirpath)
+        else:
+            self._dirname = os.path.basename(dirpath)
         self.parent_group = parent_group
-        self.title = None
+        self.stamp = None  # only recorded by incremental builds
+
+    @property
+    def dirpath(self):
+        # A loop, as each script filter asks this of every node
+        names = [self._dirname]
+        group = self.parent_group
+        while group is not None:
+            names.append(group._dirname)
+            group = group.parent_group
+        names.reverse()
+        return join(*names)
+
+    @property
+    def ancestors(self):
+        """Tuple of groups above this node, outermost first"""
+        if self.parent_group is None:
+            return ()
+        return self.parent_group.lineage
+
+    @property
+    def ancestor_path(self):
+        """Ulysses path of the group this node is in, e.g. '/Group/Sub'.
+
+        '' at the top level, as the Main group is not part of paths.
+        """
+        if self.parent_group is None:
+            return ''
+        return self.parent_group.ulysses_path
+
+    @property
+    def ancestor_alfred_path(self):
+        """Names of the groups above this node joined by spaces, as matched
+        by searches of the whole path. '' at the top."""
+        if self.parent_group is None:
+            return ''
+        return self.parent_group.alfred_path
 
     def get_ancestors(self):
-        ancestors = []
-        ancestor = self.parent_group
-        while ancestor:
-            ancestors.append(ancestor)
-            ancestor = ancestor.parent_group
-        ancestors.reverse()
-        return ancestors
+        return list(self.ancestors)
 
     def get_alfred_path_list(self):
-        return [a.name for a in self.get_ancestors()]
+        if self.parent_group is None:
+            return []
+        return list(self.parent_group.lineage_names)
 
 
 class Group(Node):
+    __slots__ = ('name', 'child_groups', 'child_sheets', 'listing',
+                 'sheet_count', 'index', 'descendent_count', 'lineage',
+                 'lineage_names', 'ulysses_path', 'alfred_path')
 
     is_group = True
     is_sheet = False
@@ -61,8 +134,23 @@ class Group(Node):
         Node.__init__(self, dirpath, parent_group)
         self.child_groups = []
         self.child_sheets = []
-        self.openable_file = join(self.dirpath, 'Info.ulgroup')
-        self.name = self.title = self._get_group_name(dirpath)
+        self.listing = None  # os.listdir; only kept by incremental builds
+        self.sheet_count = None  # only set if tree was built without sheets
+        self.index = None  # TreeIndex; only set on the root of a tree
+        self.descendent_count = None  # set by count_descendents
+        self.lineage = None  # ancestors and self; set by store_paths
+        self.lineage_names = None  # their names
+        self.ulysses_path = None  # their names, without Main, as a path
+        self.alfred_path = None  # their names, joined by spaces
+        self.name = self._get_group_name(dirpath)
+
+    @property
+    def title(self):
+        return self.name
+
+    @property
+    def openable_file(self):
+        return join(self.dirpath, 'Info.ulgroup')
 
     def _get_group_name(self, dirpath):
         if dirpath == ICLOUD_UNFILED_ROOT:
@@ -78,90 +166,698 @@ class Group(Node):
             raise Exception("Error while reading '%s'" % join(self.dirpath, 'Info.ulgroup'), e)
 
     def number_descendents(self):
-        n = len(self.child_sheets)
-        for child_group in self.child_groups:
-            n = n + child_group.number_descendents()
-        return n
+        if self.descendent_count is None:
+            count_descendents(self)
+        return self.descendent_count
 
 
 class Sheet(Node):
+    __slots__ = ('_first_line',)
 
     is_group = False
     is_sheet = True
 
     def __init__(self, dirpath, parent_group):
         Node.__init__(self, dirpath, parent_group)
-        self.dirpath = dirpath
-        self.openable_file = dirpath
-        _sheet_text_path = join(self.dirpath, 'Text.txt')
-        if os.path.exists(_sheet_text_path):
-            with open(_sheet_text_path, 'r') as f:
-                self.first_line = f.readline().decode('utf-8').strip()
-        else:
-            self.first_line = "Unknown Type"
-        self.title = self.first_line
+        self._first_line = None
+
+    @property
+    def openable_file(self):
+        return self.dirpath
+
+    @property
+    def first_line(self):
+        """First line of sheet's text; read on first use and then kept"""
+        if self._first_line is None:
+            self._first_line = self._read_first_line()
+        return self._first_line
+
+    @property
+    def title(self):
+        return self.first_line
+
+    def _read_first_line(self):
+        # Open directly rather than check first, saving a stat per sheet
+        try:
+            with open(join(self.dirpath, 'Text.txt'), 'r') as f:
+                return f.readline().decode('utf-8').strip()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        # Ulysses 13+ keeps text only in Content.xml
+        title = sheet_content.read_title(self.dirpath)
+        if title is None:
+            return "Unknown Type"
+        return title.strip()
+
+
+class TreeIndex(object):
+    """Nodes of a tree keyed by dirpath.
+
+    Built once, when first needed, and kept on the tree's root group.
+    """
+
+    def __init__(self, root_group):
+        self.by_dirpath = {}
+        groups, sheets = walk(root_group)
+        for node in groups + sheets:
+            self.add(node)
+
+    def add(self, node):
+        self.by_dirpath[node.dirpath] = node
+
+    def remove(self, node):
+        """Remove node and, if it is a group, everything below it"""
+        groups, sheets = walk(node) if node.is_group else ([], [node])
+        for n in groups + sheets:
+            if self.by_dirpath.get(n.dirpath) is n:
+                del self.by_dirpath[n.dirpath]
+
+    def find_by_dirpath(self, dirpath):
+        """KeyError if not found"""
+        return self.by_dirpath[dirpath]
+
+
+def tree_index(root_group):
+    """Return index of root_group's tree, building it if need be"""
+    if root_group.index is None:
+        root_group.index = TreeIndex(root_group)
+    return root_group.index
 
 
 def filter_nodes_by_openable_file(nodes, openable_file_list):
-    return [node for node in nodes if node.openable_file in openable_file_list]
+    openable_files = set(openable_file_list)
+    return [node for node in nodes if node.openable_file in openable_files]
+
+
+def start_mdfind(mdfind_query, query, rootdirs):
+    """Start mdfind with query, limited to rootdirs, and return the process.
 
+    ValueError if there are no rootdirs, as mdfind would then search the
+    whole system.
+    """
+    if not rootdirs:
+        raise ValueError('No directories to search with mdfind')
+    args = ['mdfind']
+    for rootdir in rootdirs:
+        args += ['-onlyin', rootdir]
+    if isinstance(query, unicode):
+        query = query.encode('utf-8')
+    args.append(mdfind_query % query)
+    return subprocess.Popen(args, stdout=subprocess.PIPE)
+
+
+def filter_nodes_by_mdfind(nodes, process):
+    """Return nodes whose openable_file is output by an mdfind process,
+    reading its output line by line as it comes"""
+    wanted = set(node.openable_file for node in nodes)
+    found = set()
+    for line in iter(process.stdout.readline, ''):
+        openable_file = line.rstrip('\n')
+        if openable_file in wanted:
+            found.add(openable_file)
+    process.stdout.close()
+    if process.wait() != 0:
+        raise subprocess.CalledProcessError(process.returncode, 'mdfind')
+    return [node for node in nodes if node.openable_file in found]
+
+
+def filter_groups_and_sheets(groups, sheets, query, rootdirs=None):
+    """Filter groups and sheets to those Spotlight finds for query.
+
+    The group and sheet queries run at the same time, each only in
+    rootdirs, which default to the library roots that exist. If there are
+    none, nothing is found.
+    """
+    if rootdirs is None:
+        rootdirs = [r for r in LIBRARY_ROOTS if os.path.exists(r)]
+    if not rootdirs:
+        return [], []
+    processes = []
+    try:
+        processes.append(start_mdfind(MDFIND_GROUP_QUERY, query, rootdirs))
+        processes.append(start_mdfind(MDFIND_SHEET_QUERY, query, rootdirs))
+        groups = filter_nodes_by_mdfind(groups, processes[0])
+        sheets = filter_nodes_by_mdfind(sheets, processes[1])
+    finally:
+        # Any still running once one has failed are not wanted
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+    return groups, sheets
 
-def filter_groups(groups, query):
-    openable_files = subprocess.check_output(
-        ['mdfind', MDFIND_GROUP_QUERY % query]).split('\n')
-    return filter_nodes_by_openable_file(groups, openable_files)
 
+def _intern(path):
+    """Intern path if possible, so trees with the same root share it"""
+    return intern(path) if isinstance(path, str) else path
 
-def filter_sheets(sheets, query):
-    openable_files = subprocess.check_output(
-        ['mdfind', MDFIND_SHEET_QUERY % query]).split('\n')
-    return filter_nodes_by_openable_file(sheets, openable_files)
 
+def classify_listing(filelist):
+    """Return sheet and group directory names from a group's listing.
 
-def create_tree(rootgroupdir, parent_group):
+    One pass over the listing, which must include the group's Info.ulgroup.
+    """
+    sheetdirlist = []
+    groupdirlist = []
+    has_info = False
+    for name in filelist:
+        if name.endswith('.ulysses'):
+            sheetdirlist.append(name)
+        elif name.endswith('-ulgroup'):
+            groupdirlist.append(name)
+        elif name == 'Info.ulgroup':
+            has_info = True
+    assert has_info
+    return sheetdirlist, groupdirlist
+
+
+def sheet_stamp(sheetpath):
+    """Return mtime of sheet's Text.txt, else of its Content.xml.
+
+    Ulysses rewrites these in place, which leaves the package directory's
+    mtime as it was. Falls back to that if the sheet has neither.
+    """
+    for name in ('Text.txt', sheet_content.CONTENT_FILE):
+        try:
+            return os.stat(join(sheetpath, name)).st_mtime
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+    return os.stat(sheetpath).st_mtime
+
+
+def group_stamp(groupdir):
+    """Return (directory mtime, Info.ulgroup mtime) of group.
+
+    The first changes when a child is added, renamed or removed, and the
+    second when the group itself is renamed.
+    """
+    return (os.stat(groupdir).st_mtime,
+            os.stat(join(groupdir, 'Info.ulgroup')).st_mtime)
+
+
+def create_tree(rootgroupdir, parent_group, previous_groups=None, stats=None,
+                include_sheets=True):
     '''recursively build group tree starting from rootgroupdir
+
+    If include_sheets is False no sheets are added; groups just record how
+    many they hold, so sheet packages are never looked inside.
+
+    In incremental mode (previous_groups is a {dirpath: Group} dict from an
+    earlier build, which may also hold sheets) each node records its stamp
+    and each group its listing. A group whose stamp (see group_stamp) is
+    unchanged is reused rather than re-parsed, as is any sheet whose stamp
+    (see sheet_stamp) is unchanged. The number of groups and sheets reused
+    and parsed is counted in stats, if given.
     '''
     assert rootgroupdir.endswith('-ulgroup')
-    filelist = os.listdir(rootgroupdir)
-    assert 'Info.ulgroup' in filelist
-    sheetdirlist = [p for p in filelist if p.endswith('.ulysses')]
-    groupdirlist = [p for p in filelist if p.endswith('-ulgroup')]
-
-    # Create group
-    group = Group(rootgroupdir, parent_group)
+    if stats is None:
+        stats = Counter()
+    incremental = previous_groups is not None
+    previous_group = previous_groups.get(rootgroupdir) if incremental else None
+
+    # Stat before listing so a change made while parsing is seen next time
+    stamp = group_stamp(rootgroupdir) if incremental else None
+    unchanged = previous_group and previous_group.stamp == stamp
+    if unchanged:
+        filelist = previous_group.listing
+    else:
+        filelist = os.listdir(rootgroupdir)
+    sheetdirlist, groupdirlist = classify_listing(filelist)
+
+    # Create group, or reuse the previous one if it is unchanged
+    if unchanged:
+        group = previous_group
+        group.parent_group = parent_group
+        previous_sheets = dict((sheet.dirpath, sheet)
+                               for sheet in group.child_sheets)
+        group.child_sheets = []
+        group.child_groups = []
+        stats['groups_reused'] += 1
+    else:
+        group = Group(rootgroupdir, parent_group)
+        previous_sheets = {}
+        if previous_group:
+            previous_sheets = dict((sheet.dirpath, sheet)
+                                   for sheet in previous_group.child_sheets)
+        stats['groups_parsed'] += 1
+    group.stamp = stamp
+    group.listing = filelist if incremental else None
+    if not include_sheets:
+        group.sheet_count = len(sheetdirlist)
+        sheetdirlist = []
 
     # Add Sheets
     for sheetdir in sheetdirlist:
-        sheet = Sheet(join(rootgroupdir, sheetdir), group)
+        sheetpath = join(rootgroupdir, sheetdir)
+        stamp = sheet_stamp(sheetpath) if incremental else None
+        sheet = previous_sheets.get(sheetpath)
+        if sheet and sheet.stamp == stamp:
+            sheet.parent_group = group
+            stats['sheets_reused'] += 1
+        else:
+            sheet = Sheet(sheetpath, group)
+            sheet.stamp = stamp
+            stats['sheets_parsed'] += 1
         group.child_sheets.append(sheet)
 
     # Recursively add groups
     for child_groupdir in groupdirlist:
-        child_group = create_tree(join(rootgroupdir, child_groupdir), group)
+        try:
+            child_group = create_tree(join(rootgroupdir, child_groupdir),
+                                      group, previous_groups, stats,
+                                      include_sheets)
+        except OSError as e:
+            _skip_incomplete_group(e)
+            continue
         assert child_group != group
         group.child_groups.append(child_group)
 
+    if parent_group is None:
+        _finish_tree(group)
     return group
 
 
+def _skip_incomplete_group(error):
+    """Note that a group was left out of a tree for error building it.
+
+    The group was synced before its Info.ulgroup, as is normal for iCloud,
+    or removed since its parent was listed. As its parent's listing holds
+    it, it is tried again when either is next seen to change.
+    """
+    logger.info('Skipping incomplete group: %s' % error)
+
+
+def group_path_components(rootgroupdir, groupdir):
+    """Return group directory names leading from rootgroupdir to groupdir.
+
+    KeyError if groupdir is not rootgroupdir or a group below it.
+    """
+    relpath = os.path.relpath(groupdir, rootgroupdir)
+    if relpath == os.curdir:
+        return []
+    components = relpath.split(os.sep)
+    if not all(c.endswith('-ulgroup') for c in components):
+        raise KeyError("Group with dirpath '%s' not in '%s'"
+                       % (groupdir, rootgroupdir))
+    return components
+
+
+def create_scoped_tree(rootgroupdir, scope_groupdir, include_sheets=True,
+                       stats=None):
+    '''build tree for just the group at scope_groupdir and return that group
+
+    Only the scope group's own subtree is built in full. The groups above
+    it are parsed for their names, as they are needed for path labels, but
+    are given no children. KeyError if scope_groupdir is not in the tree.
+    The number of groups and sheets parsed is counted in stats, if given.
+    '''
+    if stats is None:
+        stats = Counter()
+    parent_group = None
+    dirpath = rootgroupdir
+    for component in group_path_components(rootgroupdir, scope_groupdir):
+        parent_group = Group(dirpath, parent_group)
+        stats['groups_parsed'] += 1
+        dirpath = join(dirpath, component)
+    scope_group = create_tree(dirpath, parent_group, stats=stats,
+                              include_sheets=include_sheets)
+    count_descendents(scope_group)
+    store_paths(scope_group)
+    return scope_group
+
+
+def create_tree_parallel(rootgroupdir, parent_group,
+                         threads=DEFAULT_TREE_BUILDER_THREADS, stats=None):
+    '''build group tree starting from rootgroupdir using a pool of threads
+
+    Builds the same tree as create_tree in incremental mode, but one level
+    at a time: the directory listings, Info.ulgroup and Text.txt reads for
+    every group and sheet at a level are fanned out over the pool. Worth it
+    where per-file latency is high, as in iCloud's Mobile Documents.
+    '''
+    assert rootgroupdir.endswith('-ulgroup')
+    if stats is None:
+        stats = Counter()
+    root_group = _load_node((rootgroupdir, parent_group))
+    stats['groups_parsed'] += 1
+    pool = ThreadPool(threads)
+    try:
+        tasks = _child_tasks(root_group)
+        while tasks:
+            next_tasks = []
+            # map() keeps task order, so children are added in listing order
+            for node in pool.map(_load_child, tasks):
+                if node is None:
+                    continue
+                if node.is_sheet:
+                    node.parent_group.child_sheets.append(node)
+                    stats['sheets_parsed'] += 1
+                    continue
+                group = node
+                group.parent_group.child_groups.append(group)
+                stats['groups_parsed'] += 1
+                next_tasks += _child_tasks(group)
+            tasks = next_tasks
+    finally:
+        pool.close()
+    if parent_group is None:
+        _finish_tree(root_group)
+    return root_group
+
+
+def _child_tasks(group):
+    sheetdirlist, groupdirlist = classify_listing(group.listing)
+    return [(join(group.dirpath, p), group)
+            for p in sheetdirlist + groupdirlist]
+
+
+def _load_node(task):
+    """Return Group or Sheet for (dirpath, parent_group) with stamp recorded"""
+    dirpath, parent_group = task
+    if dirpath.endswith('.ulysses'):
+        node = Sheet(dirpath, parent_group)
+        node.stamp = sheet_stamp(dirpath)
+        node.first_line  # read now, while in the pool
+    else:
+        # Stamped first, so a missing Info.ulgroup is an OSError
+        stamp = group_stamp(dirpath)
+        node = Group(dirpath, parent_group)
+        node.stamp = stamp
+        node.listing = os.listdir(dirpath)
+    return node
+
+
+def _load_child(task):
+    """Return _load_node(task), or None for a group that is not complete"""
+    try:
+        return _load_node(task)
+    except OSError as e:
+        if task[0].endswith('.ulysses'):
+            raise
+        _skip_incomplete_group(e)
+        return None
+
+
+def refresh_tree(root_group, changed_dirs, stats=None):
+    """Update tree in place given directories reported as changed.
+
+    A changed sheet package has its sheet re-parsed. A changed group is
+    re-listed, picking up sheets and groups that were added, renamed or
+    removed, while keeping children that are still there. A group not yet
+    complete (see _skip_incomplete_group) is left out until reported
+    again. Directories no longer in the tree or on disk are ignored. The
+    tree's index is kept up to date.
+    """
+    if stats is None:
+        stats = Counter()
+    index = tree_index(root_group)
+    added_dirs = set()
+
+    # Parents first, so groups they add are found when their turn comes
+    for dirpath in sorted(changed_dirs, key=lambda p: p.count(os.sep)):
+        if dirpath in added_dirs or not os.path.isdir(dirpath):
+            continue
+        node = index.by_dirpath.get(dirpath)
+        if node is None:
+            # May be a group left out as incomplete, so not yet in the tree
+            # although its parent is; re-listing the parent adds it
+            node = index.by_dirpath.get(os.path.dirname(dirpath))
+            if (node is None or not node.is_group or
+                    not dirpath.endswith('-ulgroup')):
+                continue
+        if node.is_group:
+            added, removed = _relist_group(node, stats)
+            for old_node in removed:
+                index.remove(old_node)
+            for new_node in added:
+                index.add(new_node)
+                added_dirs.add(new_node.dirpath)
+        else:
+            parent_group = node.parent_group
+            sheet = Sheet(dirpath, parent_group)
+            sheet.stamp = sheet_stamp(dirpath)
+            parent_group.child_sheets[
+                parent_group.child_sheets.index(node)] = sheet
+            index.add(sheet)
+            stats['sheets_parsed'] += 1
+    count_descendents(root_group)
+    store_paths(root_group)  # groups may have been renamed or added
+    return stats
+
+
+def _relist_group(group, stats):
+    """Re-read group's name and listing.
+
+    Return the nodes added below group, and the children removed from it.
+    """
+    stamp = group_stamp(group.dirpath)
+    filelist = os.listdir(group.dirpath)
+    group.name = group._get_group_name(group.dirpath)
+    stats['groups_parsed'] += 1
+
+    previous_sheets = dict((s.dirpath, s) for s in group.child_sheets)
+    previous_groups = dict((g.dirpath, g) for g in group.child_groups)
+    group.child_sheets = []
+    group.child_groups = []
+    added = []
+    for name in filelist:
+        path = join(group.dirpath, name)
+        if name.endswith('.ulysses'):
+            sheet = previous_sheets.pop(path, None)
+            if not sheet:
+                sheet = Sheet(path, group)
+                sheet.stamp = sheet_stamp(path)
+                added.append(sheet)
+                stats['sheets_parsed'] += 1
+            group.child_sheets.append(sheet)
+        elif name.endswith('-ulgroup'):
+            child_group = previous_groups.pop(path, None)
+            if not child_group:
+                try:
+                    child_group = create_tree(path, group, {}, stats)
+                except OSError as e:
+                    _skip_incomplete_group(e)
+                    continue
+                more_groups, more_sheets = walk(child_group)
+                added += more_groups + more_sheets
+            group.child_groups.append(child_group)
+    group.stamp = stamp
+    group.listing = filelist
+    removed = previous_sheets.values() + previous_groups.values()
+    return added, removed
+
+
+def iter_groups(root_group, order=PRE_ORDER):
+    """Yield groups in root_group's tree, without recursion.
+
+    order is PRE_ORDER (parents before children, children in listing
+    order), POST_ORDER (children before parents) or BREADTH_FIRST.
+    """
+    if order == PRE_ORDER:
+        stack = [root_group]
+        while stack:
+            group = stack.pop()
+            yield group
+            stack.extend(reversed(group.child_groups))
+    elif order == POST_ORDER:
+        stack = [(root_group, False)]
+        while stack:
+            group, children_done = stack.pop()
+            if children_done:
+                yield group
+            else:
+                stack.append((group, True))
+                stack.extend((child, False)
+                             for child in reversed(group.child_groups))
+    elif order == BREADTH_FIRST:
+        queue = deque([root_group])
+        while queue:
+            group = queue.popleft()
+            yield group
+            queue.extend(group.child_groups)
+    else:
+        raise ValueError("Unknown order '%s'" % order)
+
+
+def iter_nodes(root_group, order=PRE_ORDER):
+    """Yield groups in root_group's tree in given order, each followed by
+    its sheets"""
+    for group in iter_groups(root_group, order):
+        yield group
+        for sheet in group.child_sheets:
+            yield sheet
+
+
 def walk(root_group):
-    """Walk a tree of nodes and return sheets and groups"""
-    groups = [root_group]
-    sheets = list(root_group.child_sheets)
-    for child_group in root_group.child_groups:
-        descendent_groups, descendent_sheets = walk(child_group)
-        groups += descendent_groups
-        sheets += descendent_sheets
+    """Walk a tree of nodes and return groups and sheets, both in pre-order"""
+    groups = list(iter_groups(root_group))
+    sheets = [sheet for group in groups for sheet in group.child_sheets]
     return groups, sheets
 
 
+def count_descendents(root_group):
+    """Store number of sheets below each group in a single post-order pass"""
+    for group in iter_groups(root_group, POST_ORDER):
+        if group.sheet_count is not None:
+            n = group.sheet_count
+        else:
+            n = len(group.child_sheets)
+        for child_group in group.child_groups:
+            n += child_group.descendent_count
+        group.descendent_count = n
+
+
+def store_paths(root_group):
+    """Store lineage and paths on each group in a single pre-order
+    pass. Groups above root_group are done first if they have none yet.
+    """
+    above = []
+    group = root_group.parent_group
+    while group is not None and group.lineage is None:
+        above.append(group)
+        group = group.parent_group
+    for group in reversed(above):
+        _store_path(group)
+    for group in iter_groups(root_group):
+        _store_path(group)
+
+
+def _store_path(group):
+    parent = group.parent_group
+    if parent is None:
+        group.lineage = (group,)
+        group.lineage_names = (group.name,)
+        group.ulysses_path = ('' if group.name == MAIN_GROUP_NAME
+                              else '/' + group.name)
+        group.alfred_path = group.name
+    else:
+        group.lineage = parent.lineage + (group,)
+        group.lineage_names = parent.lineage_names + (group.name,)
+        group.ulysses_path = parent.ulysses_path + '/' + group.name
+        group.alfred_path = parent.alfred_path + ' ' + group.name
+
+
+def copy_groups(root_group):
+    """Return a copy of root_group's tree with no sheets in it, as if built
+    with include_sheets False: each group records how many sheets it holds.
+    """
+    copies = {}
+    for group in iter_groups(root_group):
+        group_copy = copy.copy(group)
+        group_copy.parent_group = copies.get(id(group.parent_group),
+                                             group.parent_group)
+        if group.sheet_count is None:
+            group_copy.sheet_count = len(group.child_sheets)
+        group_copy.child_sheets = []
+        group_copy.child_groups = []
+        group_copy.listing = None
+        if group is not root_group:
+            group_copy.parent_group.child_groups.append(group_copy)
+        copies[id(group)] = group_copy
+    root_copy = copies[id(root_group)]
+    _finish_tree(root_copy)
+    return root_copy
+
+
+def _finish_tree(root_group):
+    """Count descendents and store paths in a newly built tree, and drop
+    any stale index"""
+    root_group.index = None
+    count_descendents(root_group)
+    store_paths(root_group)
+
+
 def find_group_by_path(root_group, dirpath):
-    """Walk a tree of nodes and return the one backed by given dirpath
+    """Return the group in root_group's tree backed by given dirpath
 
     KeyError if not found
     """
-    groups, _ = walk(root_group)
-    for group in groups:
-        if group.dirpath == dirpath:
-            return group
-    raise KeyError("Group with dirpath '%s' not found" % dirpath)
+    # Down through child groups by directory name, rather than through
+    # the tree's index: script filters load a tree without one, and
+    # building it asks every node for its dirpath
+    group = root_group
+    for component in group_path_components(root_group.dirpath, dirpath):
+        for child_group in group.child_groups:
+            if child_group._dirname == component:
+                group = child_group
+                break
+        else:
+            raise KeyError("Group with dirpath '%s' not found" % dirpath)
+    return group
+
+
+def tree_cache_name(rootgroupdir, include_sheets=True):
+    """Return name of workflow cache holding tree snapshot for rootgroupdir,
+    or if include_sheets is False the snapshot of just its groups"""
+    return '%s-v%i-%s' % ('tree' if include_sheets else 'groups',
+                          TREE_CACHE_VERSION,
+                          hashlib.md5(rootgroupdir).hexdigest())
+
+
+def cached_tree(wf, rootgroupdir, include_sheets=True):
+    """Return tree from the cached snapshot for rootgroupdir, or None.
+
+    If include_sheets is False the tree has just the groups (see
+    copy_groups), so no sheets are unpickled. Does not look at the library
+    itself, so the tree may be out of date.
+    """
+    snapshot = wf.cached_data(tree_cache_name(rootgroupdir, include_sheets),
+                              max_age=0)
+    if snapshot and snapshot['version'] == TREE_CACHE_VERSION:
+        return snapshot['tree']
+    return None
+
+
+def update_tree(wf, rootgroupdir, previous_tree):
+    """Rebuild tree incrementally from previous_tree and cache a snapshot.
+
+    Only groups and sheets whose stamps changed since previous_tree was
+    built are re-parsed, and the snapshot in the workflow cache dir is
+    only written if something was. Without a previous_tree the whole tree
+    is built in parallel, using the 'tree_builder_threads' setting.
+    """
+    stats = Counter()
+    if previous_tree:
+        previous_nodes = tree_index(previous_tree).by_dirpath
+        tree = create_tree(rootgroupdir, None, previous_nodes, stats)
+    else:
+        threads = wf.settings.get('tree_builder_threads',
+                                  DEFAULT_TREE_BUILDER_THREADS)
+        tree = create_tree_parallel(rootgroupdir, None, threads, stats)
+    logger.info("Tree for '%s': reused %i groups and %i sheets, "
+                "re-parsed %i groups and %i sheets" % (
+                    rootgroupdir, stats['groups_reused'],
+                    stats['sheets_reused'], stats['groups_parsed'],
+                    stats['sheets_parsed']))
+    if stats['groups_parsed'] or stats['sheets_parsed']:
+        save_tree(wf, rootgroupdir, tree)
+    return tree
+
+
+def save_tree(wf, rootgroupdir, tree):
+    """Write snapshot of tree for rootgroupdir to the workflow cache dir,
+    and one of just its groups for queries that want no sheets.
+
+    Titles of sheets not read yet are read first, so that readers of the
+    snapshot need not open any sheets.
+    """
+    _, sheets = walk(tree)
+    for sheet in sheets:
+        sheet.first_line
+    # The index is cheap to rebuild, but would double the snapshot's size
+    index, tree.index = tree.index, None
+    try:
+        wf.cache_data(tree_cache_name(rootgroupdir),
+                      {'version': TREE_CACHE_VERSION, 'tree': tree})
+    finally:
+        tree.index = index
+    wf.cache_data(tree_cache_name(rootgroupdir, include_sheets=False),
+                  {'version': TREE_CACHE_VERSION, 'tree': copy_groups(tree)})
+
+
+def load_tree(wf, rootgroupdir):
+    """Return group tree for rootgroupdir, updating the cached snapshot"""
+    return update_tree(wf, rootgroupdir, cached_tree(wf, rootgroupdir))
@@ -0,0 +1,148 @@
+from os.path import join
+import errno
+from pyexpat import ExpatError
+import xml.parsers.expat
+
+
+"""Read the text of Ulysses 13+ sheets from their Content.xml.
+
+A sheet's text is held as paragraphs in the <string> element:
+
+    <sheet version="5" ...>
+      <markup .../>
+      <string xml:space="preserve">
+        <p><tags><tag kind="heading1"># </tag></tags>Title</p>
+        <p>Body ...</p>
+      </string>
+      <attachment type="note">...</attachment>
+    </sheet>
+
+Content.xml is parsed with expat, a chunk at a time, so the title costs
+only the start of the file however long the sheet, and the whole text is
+never needed in memory at once. Text in <attribute> elements (e.g. link
+URLs, and footnotes and annotations, which hold a <string> of their own)
+and outside <string> (e.g. notes) is left out. The markup in <tag>
+elements is kept, so lines read as in Text.txt.
+
+"""
+
+
+CHUNK_SIZE = 64 * 1024
+
+CONTENT_FILE = 'Content.xml'
+
+
+class _Done(Exception):
+    """Raised from a handler to stop parsing early"""
+
+
+class _ParagraphReader(object):
+    """Collect paragraphs from Content.xml as they are parsed"""
+
+    def __init__(self, max_paragraphs=None):
+        self.max_paragraphs = max_paragraphs
+        self.paragraphs = []  # completed, not yet taken
+        self.n_paragraphs = 0
+        self._current = None  # text parts of paragraph being read
+        self._string_depth = 0
+        self._in_attribute = 0
+        self.parser = xml.parsers.expat.ParserCreate('UTF-8')
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self._start
+        self.parser.EndElementHandler = self._end
+        self.parser.CharacterDataHandler = self._text
+
+    def _start(self, name, attributes):
+        if name == 'string':
+            self._string_depth += 1
+        elif name == 'p' and self._string_depth and not self._in_attribute:
+            self._current = []
+        elif name == 'attribute':
+            self._in_attribute += 1
+
+    def _end(self, name):
+        if name == 'string':
+            self._string_depth -= 1
+            if not self._string_depth:
+                raise _Done()  # nothing more of interest
+        elif (name == 'p' and self._current is not None and
+              not self._in_attribute):
+            self.paragraphs.append(u''.join(self._current))
+            self._current = None
+            self.n_paragraphs += 1
+            if self.n_paragraphs == self.max_paragraphs:
+                raise _Done()
+        elif name == 'attribute':
+            self._in_attribute -= 1
+
+    def _text(self, data):
+        if self._current is not None and not self._in_attribute:
+            self._current.append(data)
+
+    def take(self):
+        paragraphs, self.paragraphs = self.paragraphs, []
+        return paragraphs
+
+
+def iter_paragraphs(path, max_paragraphs=None, chunk_size=CHUNK_SIZE):
+    """Yield lines of text from Content.xml at path, as they are parsed.
+
+    Stops after max_paragraphs, if given. IOError if there is no file and
+    ExpatError if it is not well formed, once the paragraphs parsed from
+    earlier chunks have been yielded.
+    """
+    reader = _ParagraphReader(max_paragraphs)
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            try:
+                reader.parser.Parse(data, not data)
+            except _Done:
+                data = ''
+            for paragraph in reader.take():
+                yield paragraph
+            if not data:
+                return
+
+
+def content_file(sheet_dirpath):
+    return join(sheet_dirpath, CONTENT_FILE)
+
+
+def read_title(sheet_dirpath):
+    """Return first line of sheet's Content.xml, or None if it has none"""
+    try:
+        for paragraph in iter_paragraphs(content_file(sheet_dirpath), 1):
+            return paragraph
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    except ExpatError:
+        pass
+    return None
+
+
+def iter_text(sheet_dirpath, chunk_size=CHUNK_SIZE):
+    """Yield sheet's text from Content.xml in pieces of whole lines.
+
+    Yields nothing if there is no Content.xml, and stops at any point where
+    it is not well formed.
+    """
+    lines = []
+    size = 0
+    try:
+        for paragraph in iter_paragraphs(content_file(sheet_dirpath),
+                                         chunk_size=chunk_size):
+            lines.append(paragraph)
+            size += len(paragraph)
+            if size >= chunk_size:
+                yield u'\n'.join(lines) + u'\n'
+                lines = []
+                size = 0
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    except ExpatError:
+        pass
+    if lines:
+        yield u'\n'.join(lines) + u'\n'
@@ -0,0 +1,105 @@
+# encoding: utf-8
+
+from os.path import dirname, abspath, join
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import parse_ulysses
+import columnar_tree
+
+from test_library_watcher import make_group, make_sheet
+from test_content_index import CacheDir
+
+
+"""Check a columnar tree, saved and mapped back in, against the tree it was
+made from, and that damaged files are not loaded.
+
+Run from the repository root with `python -m unittest discover tests`.
+
+"""
+
+
+def node_summary(node):
+    return (node.is_group, node.dirpath, node.title, node.ancestor_path,
+            [group.dirpath for group in node.get_ancestors()],
+            node.get_alfred_path_list(), node.ancestor_alfred_path)
+
+
+class ColumnarTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.root = join(self.tmpdir, 'Groups-ulgroup')
+        make_group(self.root, u'Main')
+        self.novel = join(self.root, '00000001-ulgroup')
+        make_group(self.novel, u'Café novel')
+        for i in range(2, 5):
+            make_sheet(join(self.novel, '0000000%i.ulysses' % i),
+                       u'# Chapter %i\n' % i)
+        self.drafts = join(self.novel, '00000005-ulgroup')
+        make_group(self.drafts, u'Drafts')
+        make_sheet(join(self.drafts, '00000006.ulysses'), u'# Draft\n')
+        make_group(join(self.root, '00000007-ulgroup'), u'Empty')
+        make_sheet(join(self.root, '00000008.ulysses'), u'Notes\n')
+        self.tree = parse_ulysses.create_tree(self.root, None)
+        self.wf = CacheDir(self.tmpdir)
+        columnar_tree.save(self.wf, self.root,
+                           columnar_tree.ColumnarTree.from_tree(self.tree))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def load(self):
+        return columnar_tree.load(self.wf, self.root)
+
+    def test_round_trip(self):
+        store = self.load()
+        groups, sheets = store.walk()
+        expected_groups, expected_sheets = parse_ulysses.walk(self.tree)
+        self.assertEqual([node_summary(node) for node in groups + sheets],
+                         [node_summary(node) for node in
+                          expected_groups + expected_sheets])
+        self.assertEqual([node.ancestor_alfred_path
+                          for node in expected_groups + expected_sheets],
+                         [' '.join(node.get_alfred_path_list())
+                          for node in expected_groups + expected_sheets])
+        self.assertEqual([group.number_descendents() for group in groups],
+                         [group.descendent_count
+                          for group in expected_groups])
+        for dirpath in (self.root, self.novel, self.drafts):
+            self.assertEqual(store.find_group_by_path(dirpath).dirpath,
+                             dirpath)
+        self.assertRaises(KeyError, store.find_group_by_path,
+                          join(self.novel, '0000000f-ulgroup'))
+
+    def rewrite(self, change):
+        path = columnar_tree.cache_file(self.wf, self.root)
+        with open(path, 'rb') as f:
+            data = bytearray(f.read())
+        change(data)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def test_bad_version(self):
+        def bump_version(data):
+            data[4] += 1
+        self.rewrite(bump_version)
+        self.assertIsNone(self.load())
+
+    def test_bad_size(self):
+        self.rewrite(lambda data: data.append(0))
+        self.assertIsNone(self.load())
+
+    def test_torn(self):
+        def zero_tail(data):
+            data[-10:] = '\0' * 10
+        self.rewrite(zero_tail)
+        self.assertIsNone(self.load())
+
+
+if __name__ == '__main__':
+    unittest.main()
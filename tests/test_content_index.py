@@ -0,0 +1,140 @@
+# encoding: utf-8
+
+import os
+from os.path import dirname, abspath, join
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import parse_ulysses
+import content_index
+import content_fts
+import content_search
+
+from test_library_watcher import make_group, make_sheet, write_sheet_text
+from test_parse_ulysses import bump_mtime
+
+
+"""Check searches of the content index and FTS database, and that both
+follow changes to the library.
+
+Run from the repository root with `python -m unittest discover tests`.
+
+"""
+
+
+class CacheDir(object):
+    """Stands in for the workflow, for its cachefile"""
+
+    def __init__(self, dirpath):
+        self.dirpath = dirpath
+
+    def cachefile(self, name):
+        return join(self.dirpath, name)
+
+
+class ContentIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.root = join(self.tmpdir, 'Groups-ulgroup')
+        make_group(self.root, u'Main')
+        self.novel = join(self.root, '00000001-ulgroup')
+        make_group(self.novel, u'Café novel')
+        self.chapter = join(self.novel, '00000002.ulysses')
+        make_sheet(self.chapter, u'# Chapter one\nIt was a dark night\n')
+        self.notes = join(self.root, '00000003.ulysses')
+        make_sheet(self.notes, u'# Notes\nDark roast, not decaf\n')
+        self.index = content_index.ContentIndex.open(
+            join(self.tmpdir, content_index.CONTENT_INDEX_FILE))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.tmpdir)
+
+    def nodes(self):
+        tree = parse_ulysses.create_tree(self.root, None)
+        return list(parse_ulysses.iter_nodes(tree))
+
+    def search(self, query):
+        return self.index.search(query)
+
+    def test_search(self):
+        self.assertTrue(self.index.is_empty())
+        self.assertEqual(self.index.update(self.nodes()), 4)
+        self.assertEqual(self.search(u'dark'),
+                         {self.chapter, self.notes})
+        self.assertEqual(self.search(u'DA NIG'), {self.chapter})
+        self.assertEqual(self.search(u'cafe'),
+                         {join(self.novel, 'Info.ulgroup')})
+        self.assertEqual(self.search(u'dark zebra'), set())
+        self.assertEqual(self.search(u'-'), set())
+        self.assertEqual(self.index.update(self.nodes()), 0)
+
+    def test_update_and_prune(self):
+        self.index.update(self.nodes())
+        write_sheet_text(self.chapter, u'# Chapter one\nA zebra\n')
+        bump_mtime(join(self.chapter, 'Text.txt'))
+        shutil.rmtree(self.notes)
+        self.assertEqual(self.index.update(self.nodes()), 1)
+        self.assertEqual(self.search(u'zebra'), {self.chapter})
+        self.assertEqual(self.search(u'dark'), {self.notes})
+        self.assertEqual(self.index.update(self.nodes(), prune=True), 1)
+        self.assertEqual(self.search(u'dark'), set())
+        # Words only the removed sheet held are gone from the postings
+        self.assertIsNone(self.index.conn.execute(
+            "SELECT 1 FROM postings WHERE word = 'roast'").fetchone())
+
+    def test_fts(self):
+        conn = content_fts.connect(CacheDir(self.tmpdir))
+        try:
+            self.assertEqual(content_fts.update(conn, self.nodes()), 4)
+            self.assertEqual(content_fts.search(conn, u'dark'),
+                             [self.notes, self.chapter])
+            self.assertEqual(content_fts.search(conn, u'"dark night"'),
+                             [self.chapter])
+            self.assertEqual(content_fts.search(conn, u'-'), [])
+            shutil.rmtree(self.notes)
+            self.assertEqual(content_fts.update(conn, self.nodes(),
+                                                prune=True), 1)
+            self.assertEqual(content_fts.search(conn, u'dark'),
+                             [self.chapter])
+        finally:
+            conn.close()
+
+    def test_fts_missing(self):
+        # Searches fall back to the content index, which the indexer fills
+        self.addCleanup(setattr, content_fts, 'FTS_MODULE',
+                        content_fts.FTS_MODULE)
+        self.addCleanup(setattr, content_fts, '_available', None)
+        content_fts.FTS_MODULE = 'no_such_module'
+        content_fts._available = None
+        wf = CacheDir(self.tmpdir)
+        backend = content_search.get_backend(wf, 'fts')
+        nodes = self.nodes()
+        backend.prepare(wf, nodes)
+        groups = [node for node in nodes if node.is_group]
+        sheets = [node for node in nodes if node.is_sheet]
+        self.assertEqual(backend.filter(wf, groups, sheets, u'dark',
+                                        indexed=True),
+                         ([], [node for node in sheets
+                               if node.dirpath in (self.chapter,
+                                                   self.notes)]))
+        self.assertFalse(os.path.exists(wf.cachefile(
+            content_fts.DATABASE_FILE)))
+
+    def test_match_expression(self):
+        self.assertEqual(content_fts.match_expression(u'dark ni'),
+                         u'"dark"* AND "ni"*')
+        self.assertEqual(content_fts.match_expression(u'"dark night" -'),
+                         u'"dark night"')
+        self.assertEqual(content_fts.match_expression(u'say "hi"'),
+                         u'"say"* AND "hi"')
+        self.assertIsNone(content_fts.match_expression(u'- ""'))
+
+
+if __name__ == '__main__':
+    unittest.main()
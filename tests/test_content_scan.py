@@ -0,0 +1,119 @@
+# encoding: utf-8
+
+from os.path import dirname, abspath, join
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import parse_ulysses
+import content_scan
+
+from test_library_watcher import make_group, make_sheet
+
+
+"""Check the chunked reading of sheets' text and the scan of sheets for a
+query, including its stop once limit sheets match.
+
+Run from the repository root with `python -m unittest discover tests`.
+
+"""
+
+
+class ContentScanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = join(self.tmpdir, 'Text.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, text):
+        with open(self.path, 'wb') as f:
+            f.write(text.encode('utf-8'))
+
+    def chunks(self, chunk_size, max_word=None):
+        return list(content_scan.iter_text_file(self.path, chunk_size,
+                                                max_word))
+
+    def matches(self, query, chunk_size):
+        return content_scan.text_file_matches(
+            self.path, content_scan.content_index.words(query), chunk_size)
+
+    def test_word_across_chunks(self):
+        text = u'The quick café zebra ran off\n'
+        self.write(text)
+        for chunk_size in range(1, len(text) + 2):
+            chunks = self.chunks(chunk_size)
+            self.assertEqual(u''.join(chunks), text)
+            # Chunks end between words, never in one
+            for chunk in chunks[:-1]:
+                self.assertFalse(chunk[-1].isalnum(), (chunk_size, chunks))
+            self.assertTrue(self.matches(u'zebra caf', chunk_size))
+            self.assertTrue(self.matches(u'ze', chunk_size))
+            self.assertFalse(self.matches(u'zebras', chunk_size))
+            self.assertFalse(self.matches(u'ebra', chunk_size))
+
+    def test_match_in_last_chunk(self):
+        self.write(u'filler ' * 100 + u'quagga')
+        for chunk_size in (7, 64, 100, 4096):
+            self.assertTrue(self.matches(u'filler quagga', chunk_size))
+            self.assertTrue(self.matches(u'quag', chunk_size))
+            self.assertFalse(self.matches(u'quaggas', chunk_size))
+
+    def test_long_word_cut(self):
+        # Words held back at the end of a chunk are cut to max_word
+        self.write(u'a' * 50 + u' zebra')
+        self.assertEqual(u''.join(self.chunks(8, max_word=3)), u'aaa zeb')
+        self.assertTrue(self.matches(u'aaaaa zebra', 8))
+        self.assertFalse(self.matches(u'aaaaa zebras', 8))
+
+
+class ScanSheetsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        root = join(self.tmpdir, 'Groups-ulgroup')
+        make_group(root, u'Main')
+        # Every third sheet holds 'zebra' in its text, and every ninth
+        # in its title too
+        for i in range(60):
+            if i % 9 == 0:
+                text = u'# Zebra %i\nStripes\n' % i
+            elif i % 3 == 0:
+                text = u'# Sheet %i\nA zebra\n' % i
+            else:
+                text = u'# Sheet %i\nA horse\n' % i
+            make_sheet(join(root, '%08x.ulysses' % (i + 1)), text)
+        tree = parse_ulysses.create_tree(root, None)
+        self.sheets = tree.child_sheets
+        self.sheets.sort(key=lambda sheet: sheet.dirpath)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def titles(self, sheets):
+        return [sheet.title for sheet in sheets]
+
+    def test_all(self):
+        found = content_scan.scan_sheets(self.sheets, u'zebra', 4)
+        self.assertEqual(self.titles(found),
+                         [u'# Zebra %i' % i for i in range(0, 60, 9)] +
+                         [u'# Sheet %i' % i for i in range(0, 60, 3)
+                          if i % 9])
+        self.assertEqual(content_scan.scan_sheets(self.sheets, u'-', 4), [])
+
+    def test_limit(self):
+        # The first five matches in tree order, whichever thread is quicker
+        for _ in range(5):
+            found = content_scan.scan_sheets(self.sheets, u'zebra', 4, 5)
+            self.assertEqual(self.titles(found), [
+                u'# Zebra 0', u'# Zebra 9', u'# Sheet 3', u'# Sheet 6',
+                u'# Sheet 12'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,208 @@
+# encoding: utf-8
+
+import os
+from os.path import dirname, abspath, join
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from workflow import Workflow3
+from workflow.workflow import (MATCH_ALL, MATCH_ALLCHARS, MATCH_ATOM,
+                               MATCH_CAPITALS, MATCH_INITIALS_STARTSWITH,
+                               MATCH_STARTSWITH, MATCH_SUBSTRING)
+
+import fuzzy
+import fuzzy_batch
+import ulysses_items
+
+
+"""Check fuzzy filtering against Workflow.filter, and batch against key by
+key scoring.
+
+Run from the repository root with `python -m unittest discover tests`.
+
+"""
+
+
+WORKFLOW_MATCH_ON = MATCH_ALL ^ MATCH_ALLCHARS  # as fuzzy_filter_nodes uses
+
+MATCH_ONS = [MATCH_ALL, WORKFLOW_MATCH_ON, MATCH_ALLCHARS,
+             MATCH_SUBSTRING | MATCH_ATOM, MATCH_CAPITALS,
+             MATCH_INITIALS_STARTSWITH | MATCH_STARTSWITH]
+
+SYLLABLES = [u'al', u'pha', u'caf\xe9', u'No', u'vel', u'Chap', u'ter',
+             u'x', u'ZZ', u'\xfcber', u'Gr', u'o', u'up', u'2017', u'-',
+             u'.', u'Draft', u'İ', u'K', u'☃']
+
+WORDS = [u'a', u'al', u'cha', u'nc', u'caf', u'cafe', u'caf\xe9', u'ub',
+         u'gr', u'zz', u'2017', u'dra', u'ing', u'x', u'apter', u'ncd',
+         u'k', u'i', u'☃', u'-']
+
+
+def make_keys(rng, n):
+    def word():
+        return u''.join(rng.choice(SYLLABLES)
+                        for _ in range(rng.randint(1, 3)))
+    keys = [u' '.join(word() for _ in range(rng.randint(1, 5)))
+            for _ in range(n)]
+    return keys + [u'', u'  ', u'a', u' x ']
+
+
+class TitledNode(object):
+    """Stands in for a group or sheet, for fuzzy_filter_nodes"""
+
+    def __init__(self, title):
+        self.title = title
+        self.ancestor_alfred_path = ''
+
+
+def make_queries(rng, n):
+    return [u' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 3)))
+            for _ in range(n)]
+
+
+class FuzzyFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ['alfred_workflow_cache'] = join(self.tmpdir, 'cache')
+        os.environ['alfred_workflow_data'] = join(self.tmpdir, 'data')
+        self.wf = Workflow3()
+        self.rng = random.Random(0)
+        self.keys = make_keys(self.rng, 500)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        fuzzy_batch.numpy = fuzzy_batch.import_numpy()
+        shutil.rmtree(self.tmpdir)
+
+    def workflow_filter(self, query, **kwargs):
+        results = self.wf.filter(query, list(enumerate(self.keys)),
+                                 key=lambda item: item[1],
+                                 include_score=True, **kwargs)
+        return [(item[0], score, rule) for item, score, rule in results]
+
+    def test_matches_workflow_filter(self):
+        corpus = fuzzy.PreparedCorpus(self.keys)
+        for query in make_queries(self.rng, 40):
+            for match_on in MATCH_ONS:
+                self.assertEqual(
+                    corpus.filter(query, match_on=match_on, max_results=20),
+                    self.workflow_filter(query, match_on=match_on,
+                                         max_results=20))
+
+    def test_session_matches_workflow_filter(self):
+        for index in (False, True):
+            name = 'keys-%s' % index
+            fuzzy.load_corpus(self.wf, name, self.keys, index)  # saved
+            for query in [u'c', u'ca', u'caf', u'caf x', u'n', u'nc']:
+                corpus = fuzzy.load_corpus(self.wf, name, self.keys, index)
+                self.assertEqual(index, corpus.index is not None)
+                self.assertEqual(
+                    fuzzy.filter_in_session(self.wf, name, corpus, query,
+                                            match_on=WORKFLOW_MATCH_ON,
+                                            max_results=20),
+                    self.workflow_filter(query, match_on=WORKFLOW_MATCH_ON,
+                                         max_results=20))
+
+    def record_candidates(self):
+        """Return list that gets the candidates of every corpus filter"""
+        calls = []
+        filter = fuzzy.PreparedCorpus.__dict__['filter']
+
+        def recording_filter(corpus, query, **kwargs):
+            calls.append(kwargs.get('candidates'))
+            return filter(corpus, query, **kwargs)
+        self.addCleanup(setattr, fuzzy.PreparedCorpus, 'filter', filter)
+        fuzzy.PreparedCorpus.filter = recording_filter
+        return calls
+
+    def session_filter(self, keys, query):
+        corpus = fuzzy.load_corpus(self.wf, 'keys', keys)
+        return fuzzy.filter_in_session(self.wf, 'keys', corpus, query,
+                                       match_on=WORKFLOW_MATCH_ON,
+                                       max_results=20)
+
+    def test_session_refines_extended_query(self):
+        calls = self.record_candidates()
+        # Whether each query extends the one before
+        for query, refined in [(u'c', False), (u'ca', True),
+                               (u'ca x', True), (u'caf x', True),
+                               (u'ca', False), (u'n', False)]:
+            previous = self.wf.cached_data('fuzzy-refine-keys', max_age=0,
+                                           session=True)
+            self.assertEqual(self.session_filter(self.keys, query),
+                             self.workflow_filter(query,
+                                                  match_on=WORKFLOW_MATCH_ON,
+                                                  max_results=20))
+            self.assertEqual(calls[-1],
+                             previous['matches'] if refined else None, query)
+
+    def test_session_new_keys_filtered_in_full(self):
+        calls = self.record_candidates()
+        self.session_filter(self.keys, u'ca')
+        self.keys.append(u'cafe extra')  # a new digest, so a new corpus
+        self.assertEqual(self.session_filter(self.keys, u'caf x'),
+                         self.workflow_filter(u'caf x',
+                                              match_on=WORKFLOW_MATCH_ON,
+                                              max_results=20))
+        self.assertIsNone(calls[-1])
+
+    def test_filter_nodes_max_results(self):
+        # Set by ulysses_items.main
+        self.addCleanup(setattr, ulysses_items, 'logger',
+                        ulysses_items.logger)
+        ulysses_items.logger = self.wf.logger
+        nodes = [TitledNode(key) for key in self.keys]
+
+        def filter_nodes(max_results):
+            return [nodes.index(node)
+                    for node in ulysses_items.fuzzy_filter_nodes(
+                        self.wf, nodes, u'ca', False, 'nodes', max_results)]
+        for max_results in (0, 1, 5):
+            self.assertEqual(filter_nodes(max_results),
+                             [i for i, _, _ in self.workflow_filter(
+                                 u'ca', match_on=WORKFLOW_MATCH_ON,
+                                 max_results=max_results)])
+        self.assertGreater(len(filter_nodes(0)), 5)  # 0 is no cap
+
+    def assert_batch_matches_items(self):
+        corpus = fuzzy.PreparedCorpus(self.keys, index=False)
+        for loaded in (corpus,
+                       fuzzy.PreparedCorpus.from_state(corpus.state(),
+                                                       self.keys)):
+            for query in make_queries(self.rng, 40):
+                options = {
+                    'match_on': self.rng.choice(MATCH_ONS),
+                    'fold_diacritics': self.rng.choice([True, False]),
+                    'ascending': self.rng.choice([True, False]),
+                    'min_score': self.rng.choice([0, 60]),
+                    'max_results': self.rng.choice([0, 10]),
+                    'candidates': self.rng.choice(
+                        [None, sorted(self.rng.sample(
+                            range(len(self.keys)), 300))]),
+                }
+                item_survivors = []
+                batch_survivors = []
+                self.assertEqual(
+                    corpus.filter(query, survivors=item_survivors,
+                                  **options),
+                    loaded.filter(query, survivors=batch_survivors,
+                                  batch=True, **options))
+                self.assertEqual(item_survivors, batch_survivors)
+
+    def test_batch_matches_items_numpy(self):
+        if fuzzy_batch.import_numpy() is None:
+            self.skipTest('NumPy is not installed')
+        self.assert_batch_matches_items()
+
+    def test_batch_matches_items_python(self):
+        fuzzy_batch.import_numpy()
+        fuzzy_batch.numpy = None
+        self.assert_batch_matches_items()
@@ -0,0 +1,151 @@
+# encoding: utf-8
+
+import os
+from os.path import dirname, abspath, join
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import biplist
+
+import library_watcher
+import parse_ulysses
+
+
+"""Check trees updated from watcher changes against freshly built ones.
+
+Run from the repository root with `python -m unittest discover tests`.
+
+"""
+
+
+TIMEOUT = 2.0  # seconds to wait for a change to be reported
+DEBOUNCE = 0.1
+
+
+def make_group(groupdir, name):
+    os.mkdir(groupdir)
+    write_group_name(groupdir, name)
+
+
+def write_group_name(groupdir, name):
+    biplist.writePlist({'displayName': name}, join(groupdir, 'Info.ulgroup'))
+
+
+def make_sheet(sheetdir, text):
+    os.mkdir(sheetdir)
+    write_sheet_text(sheetdir, text)
+
+
+def write_sheet_text(sheetdir, text):
+    # In place, as Ulysses does, so the package directory is left alone
+    with open(join(sheetdir, 'Text.txt'), 'w') as f:
+        f.write(text.encode('utf-8'))
+
+
+def tree_summary(root_group):
+    """Return what is shown of each node in tree order"""
+    return [(node.is_group, node.dirpath, node.title, node.ancestor_path,
+             node.ancestor_alfred_path)
+            for node in parse_ulysses.iter_nodes(root_group)]
+
+
+class WatcherTestMixin(object):
+
+    watcher_class = 'override'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.root = join(self.tmpdir, 'Groups-ulgroup')
+        make_group(self.root, u'Main')
+        self.group = join(self.root, '00000001-ulgroup')
+        make_group(self.group, u'Novel')
+        self.sheet = join(self.group, '00000002.ulysses')
+        make_sheet(self.sheet, u'# Chapter one\nIt was a dark night\n')
+        make_sheet(join(self.root, '00000003.ulysses'), u'Notes\n')
+        self.tree = parse_ulysses.create_tree(self.root, None)
+        self.watcher = self.watcher_class([self.root], DEBOUNCE)
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.tmpdir)
+
+    def assert_tree_refreshed(self):
+        changed = self.watcher.wait_for_changes(TIMEOUT)
+        self.assertTrue(changed)
+        parse_ulysses.refresh_tree(self.tree, changed)
+        self.assertEqual(tree_summary(self.tree), tree_summary(
+            parse_ulysses.create_tree(self.root, None)))
+
+    def test_edit_sheet(self):
+        write_sheet_text(self.sheet, u'# Chapter 1\nIt was a dark night\n')
+        self.assert_tree_refreshed()
+
+    def test_rename_group(self):
+        write_group_name(self.group, u'Short story')
+        self.assert_tree_refreshed()
+
+    def test_move_sheet(self):
+        os.rename(self.sheet, join(self.root, '00000002.ulysses'))
+        self.assert_tree_refreshed()
+
+    def test_add_sheet_and_group(self):
+        make_sheet(join(self.group, '00000004.ulysses'), u'# Chapter two\n')
+        subgroup = join(self.group, '00000005-ulgroup')
+        make_group(subgroup, u'Drafts')
+        make_sheet(join(subgroup, '00000006.ulysses'), u'# Draft\n')
+        self.assert_tree_refreshed()
+
+    def test_group_synced_before_info(self):
+        # Until its Info.ulgroup arrives the group is left out
+        subgroup = join(self.group, '00000005-ulgroup')
+        os.mkdir(subgroup)
+        make_sheet(join(subgroup, '00000006.ulysses'), u'# Draft\n')
+        changed = self.watcher.wait_for_changes(TIMEOUT)
+        self.assertTrue(changed)
+        parse_ulysses.refresh_tree(self.tree, changed)
+        self.assertEqual(tree_summary(self.tree), tree_summary(
+            parse_ulysses.create_tree(self.root, None, {})))
+        self.assertNotIn(subgroup, [group.dirpath for group in
+                                    parse_ulysses.iter_groups(self.tree)])
+        write_group_name(subgroup, u'Drafts')
+        self.assert_tree_refreshed()
+
+
+class PollingWatcherTest(WatcherTestMixin, unittest.TestCase):
+
+    watcher_class = library_watcher.PollingWatcher
+
+
+class InotifyWatcherTest(WatcherTestMixin, unittest.TestCase):
+
+    watcher_class = library_watcher.InotifyWatcher
+
+    def setUp(self):
+        try:
+            library_watcher.InotifyWatcher([], DEBOUNCE).close()
+        except (OSError, AttributeError):
+            self.skipTest('inotify unavailable')
+        WatcherTestMixin.setUp(self)
+
+    def test_queue_overflow(self):
+        # Changes dropped with the queue are found by rebuilding from roots
+        write_sheet_text(self.sheet, u'# Chapter 1\nIt was a dark night\n')
+        make_sheet(join(self.group, '00000004.ulysses'), u'# Chapter two\n')
+        self.watcher.wait_for_changes(TIMEOUT)
+        changed = self.watcher._changes_from_events(
+            library_watcher._EVENT_HEADER.pack(
+                -1, library_watcher.IN_Q_OVERFLOW, 0, 0))
+        self.assertEqual(changed, set([self.root]))
+        # As update_tree rebuilds it
+        tree = parse_ulysses.create_tree(
+            self.root, None, parse_ulysses.tree_index(self.tree).by_dirpath)
+        self.assertEqual(tree_summary(tree), tree_summary(
+            parse_ulysses.create_tree(self.root, None)))
+
+
+if __name__ == '__main__':
+    unittest.main()
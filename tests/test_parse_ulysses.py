@@ -0,0 +1,271 @@
+# encoding: utf-8
+
+import os
+from os.path import dirname, abspath, join
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from collections import Counter
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import parse_ulysses
+import ulysses_indexer
+
+from test_library_watcher import (make_group, make_sheet, write_group_name,
+                                  write_sheet_text, tree_summary)
+
+
+"""Check trees built in parallel or incrementally against ones built
+afresh by create_tree.
+
+Run from the repository root with `python -m unittest discover tests`.
+
+"""
+
+
+def full_summary(root_group):
+    """Return what is shown and kept of each node in tree order"""
+    return [summary + (node.stamp, node.descendent_count
+                       if node.is_group else None)
+            for summary, node in zip(tree_summary(root_group),
+                                     parse_ulysses.iter_nodes(root_group))]
+
+
+def bump_mtime(path):
+    # A second on, so the change is seen whatever the mtime resolution
+    mtime = os.stat(path).st_mtime + 1
+    os.utime(path, (mtime, mtime))
+
+
+class LibraryTestMixin(object):
+    """Builds a small library in a temporary directory"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.root = join(self.tmpdir, 'Groups-ulgroup')
+        make_group(self.root, u'Main')
+        self.novel = join(self.root, '00000001-ulgroup')
+        make_group(self.novel, u'Novel')
+        self.chapter = join(self.novel, '00000002.ulysses')
+        make_sheet(self.chapter, u'# Chapter one\nIt was a dark night\n')
+        for i in range(3, 8):
+            make_sheet(join(self.novel, '0000000%i.ulysses' % i),
+                       u'# Chapter %i\n' % i)
+        self.drafts = join(self.novel, '00000008-ulgroup')
+        make_group(self.drafts, u'Drafts')
+        make_sheet(join(self.drafts, '00000009.ulysses'), u'# Draft\n')
+        make_group(join(self.root, '0000000a-ulgroup'), u'Empty')
+        self.notes = join(self.root, '0000000b.ulysses')
+        make_sheet(self.notes, u'Notes\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def create_tree(self):
+        return parse_ulysses.create_tree(self.root, None, {})
+
+
+class CreateTreeTest(LibraryTestMixin, unittest.TestCase):
+
+    def test_parallel_matches_serial(self):
+        for threads in (1, 4):
+            tree = parse_ulysses.create_tree_parallel(self.root, None,
+                                                      threads)
+            self.assertEqual(full_summary(tree),
+                             full_summary(self.create_tree()))
+            self.assertEqual(
+                [group.listing for group in parse_ulysses.iter_groups(tree)],
+                [group.listing for group in
+                 parse_ulysses.iter_groups(self.create_tree())])
+
+    def test_find_group_by_path(self):
+        tree = self.create_tree()
+        for dirpath in (self.root, self.novel, self.drafts):
+            self.assertEqual(
+                parse_ulysses.find_group_by_path(tree, dirpath).dirpath,
+                dirpath)
+        for dirpath in (join(self.root, '0000000f-ulgroup'), self.notes,
+                        self.tmpdir):
+            self.assertRaises(KeyError, parse_ulysses.find_group_by_path,
+                              tree, dirpath)
+
+    def test_iter_groups_order(self):
+        tree = self.create_tree()
+        empty = join(self.root, '0000000a-ulgroup')
+
+        def dirpaths(order):
+            return [group.dirpath
+                    for group in parse_ulysses.iter_groups(tree, order)]
+        self.assertEqual(dirpaths(parse_ulysses.PRE_ORDER),
+                         [self.root, self.novel, self.drafts, empty])
+        self.assertEqual(dirpaths(parse_ulysses.POST_ORDER),
+                         [self.drafts, self.novel, empty, self.root])
+        self.assertEqual(dirpaths(parse_ulysses.BREADTH_FIRST),
+                         [self.root, self.novel, empty, self.drafts])
+        self.assertRaises(ValueError, dirpaths, 'sideways')
+
+    def test_scoped_tree(self):
+        for include_sheets in (True, False):
+            stats = Counter()
+            scope_group = parse_ulysses.create_scoped_tree(
+                self.root, self.novel, include_sheets, stats)
+            tree = parse_ulysses.create_tree(self.root, None,
+                                             include_sheets=include_sheets)
+            self.assertEqual(full_summary(scope_group), full_summary(
+                parse_ulysses.find_group_by_path(tree, self.novel)))
+            # Main just for its name, then Novel and Drafts, but not Empty
+            # or the Notes sheet beside them
+            self.assertEqual(stats['groups_parsed'], 3)
+            self.assertEqual(stats['sheets_parsed'],
+                             7 if include_sheets else 0)
+        self.assertRaises(KeyError, parse_ulysses.create_scoped_tree,
+                          self.root, self.tmpdir)
+
+    def test_load_scope_group_without_sheets(self):
+        # Before the indexer is ready the scope group's subtree is built
+        self.addCleanup(setattr, ulysses_indexer, 'is_ready',
+                        ulysses_indexer.is_ready)
+        ulysses_indexer.is_ready = lambda wf: False
+        scope_group = ulysses_indexer.load_scope_group(
+            None, self.root, self.drafts, include_sheets=False)
+        self.assertEqual(full_summary(scope_group), full_summary(
+            parse_ulysses.create_scoped_tree(self.root, self.drafts,
+                                             include_sheets=False)))
+        self.assertEqual((scope_group.child_sheets, scope_group.sheet_count),
+                         ([], 1))
+        self.assertRaises(KeyError, ulysses_indexer.load_scope_group,
+                          None, self.root, self.tmpdir)
+
+    def test_incomplete_group_left_out(self):
+        incomplete = join(self.novel, '0000000c-ulgroup')
+        os.mkdir(incomplete)
+        make_sheet(join(incomplete, '0000000d.ulysses'), u'# Later\n')
+        expected = full_summary(self.create_tree())
+        self.assertEqual(
+            full_summary(parse_ulysses.create_tree_parallel(self.root, None)),
+            expected)
+        self.assertNotIn(incomplete, [node[1] for node in expected])
+
+    def test_copy_groups(self):
+        def groups_summary(root_group):
+            return [(group.dirpath, group.title, group.ancestor_path,
+                     group.descendent_count, group.sheet_count,
+                     group.child_sheets)
+                    for group in parse_ulysses.iter_groups(root_group)]
+        tree = self.create_tree()
+        self.assertEqual(
+            groups_summary(parse_ulysses.copy_groups(tree)),
+            groups_summary(parse_ulysses.create_tree(self.root, None,
+                                                     include_sheets=False)))
+        self.assertEqual(len(parse_ulysses.find_group_by_path(
+            tree, self.novel).child_sheets), 6)  # left as it was
+
+    def assert_update_matches_fresh(self, previous_tree):
+        stats = Counter()
+        tree = parse_ulysses.create_tree(
+            self.root, None,
+            parse_ulysses.tree_index(previous_tree).by_dirpath, stats)
+        self.assertEqual(full_summary(tree), full_summary(self.create_tree()))
+        return stats
+
+    def test_update_unchanged(self):
+        stats = self.assert_update_matches_fresh(self.create_tree())
+        self.assertEqual((stats['groups_parsed'], stats['sheets_parsed']),
+                         (0, 0))
+
+    def change_library(self):
+        write_sheet_text(self.chapter, u'# Chapter 1\n')
+        bump_mtime(join(self.chapter, 'Text.txt'))
+        write_group_name(self.drafts, u'Old drafts')
+        bump_mtime(join(self.drafts, 'Info.ulgroup'))
+        os.rename(self.notes, join(self.drafts, '0000000b.ulysses'))
+        make_group(join(self.drafts, '0000000c-ulgroup'), u'Later')
+        bump_mtime(self.root)
+        bump_mtime(self.drafts)
+
+    def test_update_after_changes(self):
+        previous_tree = self.create_tree()
+        self.change_library()
+        stats = self.assert_update_matches_fresh(previous_tree)
+        self.assertTrue(stats['groups_reused'])
+        self.assertTrue(stats['sheets_reused'])
+
+    def test_update_parallel_tree_after_changes(self):
+        previous_tree = parse_ulysses.create_tree_parallel(self.root, None)
+        self.change_library()
+        stats = self.assert_update_matches_fresh(previous_tree)
+        self.assertTrue(stats['sheets_reused'])
+
+
+# Stands in for mdfind: logs its arguments, and prints the paths in
+# $MDFIND_GROUPS or $MDFIND_SHEETS, exiting with $MDFIND_GROUP_STATUS for
+# a group query
+FAKE_MDFIND = """#!/bin/sh
+echo "$@" >> "$MDFIND_LOG"
+case "$*" in
+  *"Ulysses Group"*) printf "$MDFIND_GROUPS"; exit $MDFIND_GROUP_STATUS;;
+  *) sleep "$MDFIND_SHEET_DELAY"; printf "$MDFIND_SHEETS";;
+esac
+"""
+
+
+class MdfindTest(LibraryTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        LibraryTestMixin.setUp(self)
+        bindir = join(self.tmpdir, 'bin')
+        os.mkdir(bindir)
+        with open(join(bindir, 'mdfind'), 'w') as f:
+            f.write(FAKE_MDFIND)
+        os.chmod(join(bindir, 'mdfind'), 0755)
+        self.log = join(self.tmpdir, 'mdfind.log')
+        self.environ = os.environ.copy()
+        os.environ.update(
+            PATH=bindir + os.pathsep + os.environ['PATH'],
+            MDFIND_LOG=self.log,
+            MDFIND_GROUPS=join(self.drafts, 'Info.ulgroup') + '\\n',
+            MDFIND_SHEETS='%s\\n%s\\n' % (self.notes, '/elsewhere.ulysses'),
+            MDFIND_GROUP_STATUS='0', MDFIND_SHEET_DELAY='0')
+        self.groups, self.sheets = parse_ulysses.walk(self.create_tree())
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        LibraryTestMixin.tearDown(self)
+
+    def filter(self, rootdirs):
+        return parse_ulysses.filter_groups_and_sheets(
+            self.groups, self.sheets, u'café', rootdirs)
+
+    def mdfind_calls(self):
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as f:
+            return f.read().splitlines()
+
+    def test_filter(self):
+        groups, sheets = self.filter([self.root])
+        self.assertEqual([group.dirpath for group in groups], [self.drafts])
+        self.assertEqual([sheet.dirpath for sheet in sheets], [self.notes])
+        for call in self.mdfind_calls():
+            self.assertTrue(call.startswith('-onlyin %s ' % self.root))
+
+    def test_no_roots(self):
+        self.assertEqual(self.filter([]), ([], []))
+        self.assertEqual(self.mdfind_calls(), [])
+
+    def test_group_query_fails(self):
+        # The sheet query, still running, is stopped rather than waited for
+        os.environ.update(MDFIND_GROUP_STATUS='1', MDFIND_SHEET_DELAY='10')
+        start = time.time()
+        self.assertRaises(subprocess.CalledProcessError, self.filter,
+                          [self.root])
+        self.assertLess(time.time() - start, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
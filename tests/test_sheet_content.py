@@ -0,0 +1,120 @@
+# encoding: utf-8
+
+import os
+from os.path import dirname, abspath, join
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import parse_ulysses
+import sheet_content
+
+
+"""Check text read from Ulysses 13+ Content.xml, and sheet titles read from
+it when a sheet has no Text.txt.
+
+Run from the repository root with `python -m unittest discover tests`.
+
+"""
+
+
+HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+          '<sheet version="5" app_version="13">'
+          '<markup version="1" identifier="markdownxl"/>'
+          '<string xml:space="preserve">\n')
+
+FOOTER = ('</string>'
+          '<attachment type="note"><string xml:space="preserve">'
+          '<p>A note</p></string></attachment>'
+          '</sheet>\n')
+
+TITLE = u'<p><tags><tag kind="heading1"># </tag></tags>Café</p>\n'
+
+LINK = (u'<p>See <element kind="link"><attribute identifier="URL">'
+        u'http://example.com</attribute>this page</element></p>\n')
+
+FOOTNOTE = (u'<p>Before <element kind="footnote">'
+            u'<attribute identifier="text"><string xml:space="preserve">'
+            u'<p>the note</p></string></attribute></element> after</p>\n')
+
+
+def body(n):
+    return u''.join(u'<p>Line %i of the body</p>\n' % i for i in range(n))
+
+
+def body_text(n):
+    return u''.join(u'Line %i of the body\n' % i for i in range(n))
+
+
+class SheetContentTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.sheetdir = join(self.tmpdir, '00000001.ulysses')
+        os.mkdir(self.sheetdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_content(self, paragraphs, footer=FOOTER):
+        with open(sheet_content.content_file(self.sheetdir), 'wb') as f:
+            f.write(HEADER + paragraphs.encode('utf-8') + footer)
+
+    def text(self, chunk_size=sheet_content.CHUNK_SIZE):
+        return u''.join(sheet_content.iter_text(self.sheetdir, chunk_size))
+
+    def test_text(self):
+        self.write_content(TITLE + LINK + body(3))
+        self.assertEqual(self.text(), u'# Café\nSee this page\n' +
+                         body_text(3))
+        self.assertEqual(self.text(64), u'# Café\nSee this page\n' +
+                         body_text(3))
+
+    def test_footnote(self):
+        self.write_content(u'<p>Title</p>\n' + FOOTNOTE +
+                           u'<p>Last paragraph zebra</p>\n')
+        self.assertEqual(self.text(), u'Title\nBefore  after\n'
+                         u'Last paragraph zebra\n')
+        self.write_content(FOOTNOTE + body(1))
+        self.assertEqual(sheet_content.read_title(self.sheetdir),
+                         u'Before  after')
+
+    def test_title_stops_early(self):
+        # Had the rest been parsed, the error would have lost the title
+        self.write_content(TITLE + u'<p>Fish & chips</p>\n')
+        self.assertEqual(sheet_content.read_title(self.sheetdir), u'# Café')
+
+    def test_malformed_part_way(self):
+        self.write_content(TITLE + body(100) + u'<p>Fish & chips</p>\n')
+        text = self.text(256)
+        self.assertTrue(text.startswith(u'# Café\nLine 0 of the body\n'))
+        self.assertTrue((u'# Café\n' + body_text(100)).startswith(text))
+        self.assertEqual(self.text(), u'')  # all in one chunk
+
+    def test_no_content(self):
+        self.assertEqual(self.text(), u'')
+        self.assertIsNone(sheet_content.read_title(self.sheetdir))
+        self.write_content(u'', footer='</string></sheet>\n')
+        self.assertIsNone(sheet_content.read_title(self.sheetdir))
+
+    def sheet_title(self):
+        return parse_ulysses.Sheet(self.sheetdir, None).title
+
+    def test_sheet_title(self):
+        self.write_content(TITLE + body(1))
+        self.assertEqual(self.sheet_title(), u'# Café')
+        with open(join(self.sheetdir, 'Text.txt'), 'w') as f:
+            f.write(u'# Café au lait\nLine 0 of the body\n'.encode('utf-8'))
+        self.assertEqual(self.sheet_title(), u'# Café au lait')
+
+    def test_sheet_title_unknown(self):
+        self.assertEqual(self.sheet_title(), 'Unknown Type')
+        self.write_content(u'<p>Fish & chips</p>\n')
+        self.assertEqual(self.sheet_title(), 'Unknown Type')
+
+
+if __name__ == '__main__':
+    unittest.main()
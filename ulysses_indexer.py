@@ -0,0 +1,230 @@
+#!/usr/bin/python
+# encoding: utf-8
+
+import sys
+import os
+import time
+
+import workflow.workflow3
+from workflow.background import is_running, run_in_background
+
+import parse_ulysses
+import library_watcher
+import columnar_tree
+import content_search
+from parse_ulysses import LIBRARY_ROOTS
+
+
+"""Keep cached Ulysses library trees up to date from the background.
+
+Started by ulysses_items.py on first use. After one incremental rebuild
+on start-up, trees are updated in place from the directories
+library_watcher reports as changed. Once that rebuild is done (see
+is_ready), script filters read the cached trees as they are and never walk
+the library themselves. The indexer exits once the workflow has not been
+used for the idle period in the 'indexer_idle_timeout' setting.
+
+Any stored index used by the content_search backend in the
+'content_backend' setting is kept up to date along with the trees. With
+the 'tree_store' setting set to 'columnar', a columnar_tree store is also
+written for each tree, and script filters read that instead of the
+pickled tree.
+
+"""
+
+
+INDEXER_NAME = 'ulysses_indexer'
+
+DEFAULT_IDLE_TIMEOUT = 600  # seconds since workflow was last used
+DEFAULT_SCAN_INTERVAL = 5  # seconds between idle checks (and polls)
+
+LAST_USED_FILE = 'indexer.lastused'
+READY_FILE = 'indexer.ready'  # written once start-up rebuild is done
+
+logger = None
+
+
+def main(wf):
+    idle_timeout = wf.settings.get('indexer_idle_timeout',
+                                   DEFAULT_IDLE_TIMEOUT)
+    scan_interval = wf.settings.get('indexer_scan_interval',
+                                    DEFAULT_SCAN_INTERVAL)
+    debounce = wf.settings.get('indexer_debounce',
+                               library_watcher.DEFAULT_DEBOUNCE)
+    logger.info('Indexer started (idle timeout %ss)' % idle_timeout)
+
+    rootdirs = [r for r in LIBRARY_ROOTS if os.path.exists(r)]
+    # Watch before rebuilding so that no change is missed in between
+    watcher = library_watcher.create_watcher(rootdirs, debounce)
+    trees = dict((rootdir, parse_ulysses.update_tree(
+                    wf, rootdir, parse_ulysses.cached_tree(wf, rootdir)))
+                 for rootdir in rootdirs)
+    if use_columnar_store(wf):
+        for rootdir in rootdirs:
+            columnar_tree.save(wf, rootdir,
+                               columnar_tree.ColumnarTree.from_tree(
+                                   trees[rootdir]))
+    update_content_index(wf, trees)
+    with open(wf.cachefile(READY_FILE), 'w'):
+        pass
+
+    stale_roots = set()  # roots whose last update failed
+    while seconds_since_last_used(wf) < idle_timeout:
+        changed_dirs = watcher.wait_for_changes(scan_interval)
+        updated = False
+        for rootdir in rootdirs:
+            changed_in_root = [d for d in changed_dirs if
+                               d == rootdir or d.startswith(rootdir + os.sep)]
+            if rootdir in stale_roots:
+                changed_in_root.append(rootdir)
+            if not changed_in_root:
+                continue
+            # One bad directory must not stop the indexer. As some of the
+            # changes may be lost, the whole root is checked next time.
+            try:
+                trees[rootdir] = update_root(wf, rootdir, trees[rootdir],
+                                             changed_in_root)
+            except Exception:
+                logger.exception("Could not update tree for '%s'; will "
+                                 "check all of it again" % rootdir)
+                stale_roots.add(rootdir)
+                continue
+            stale_roots.discard(rootdir)
+            updated = True
+        if updated:
+            try:
+                update_content_index(wf, trees)
+            except Exception:
+                logger.exception('Could not update content index')
+
+    watcher.close()
+    logger.info('Indexer idle for %ss; exiting' % idle_timeout)
+
+
+def update_root(wf, rootdir, tree, changed_dirs):
+    """Return tree for rootdir brought up to date given the directories in
+    it reported as changed, and save it"""
+    if rootdir in changed_dirs:
+        # Changes may have been lost (see library_watcher), so every stamp
+        # is checked, reusing what has not changed
+        tree = parse_ulysses.update_tree(wf, rootdir, tree)
+    else:
+        stats = parse_ulysses.refresh_tree(tree, changed_dirs)
+        logger.info("Refreshed %i groups and %i sheets in '%s'" % (
+            stats['groups_parsed'], stats['sheets_parsed'], rootdir))
+        parse_ulysses.save_tree(wf, rootdir, tree)
+    if use_columnar_store(wf):
+        columnar_tree.save(wf, rootdir,
+                           columnar_tree.ColumnarTree.from_tree(tree))
+    return tree
+
+
+def update_content_index(wf, trees):
+    nodes = []
+    for tree in trees.values():
+        groups, sheets = parse_ulysses.walk(tree)
+        nodes += groups + sheets
+    content_search.get_backend(wf).prepare(wf, nodes)
+
+
+def seconds_since_last_used(wf):
+    try:
+        return time.time() - os.stat(wf.cachefile(LAST_USED_FILE)).st_mtime
+    except OSError:
+        return float('inf')  # never used
+
+
+def start_indexer(wf):
+    """Record that the workflow is in use and start indexer if not running"""
+    with open(wf.cachefile(LAST_USED_FILE), 'w'):
+        pass
+    if not is_running(INDEXER_NAME):
+        # Any marker left is from an earlier indexer (see is_ready)
+        try:
+            os.remove(wf.cachefile(READY_FILE))
+        except OSError:
+            pass
+        run_in_background(INDEXER_NAME,
+                          ['/usr/bin/python',
+                           wf.workflowfile('ulysses_indexer.py')])
+
+
+def is_ready(wf):
+    """True if the indexer is running and has brought the cached trees and
+    content index up to date since it started.
+
+    Until then, what is cached may be left from an earlier session.
+    start_indexer removes the marker the indexer writes when it is done.
+    """
+    return (is_running(INDEXER_NAME) and
+            os.path.exists(wf.cachefile(READY_FILE)))
+
+
+def use_columnar_store(wf):
+    return wf.settings.get('tree_store') == 'columnar'
+
+
+def load_groups_and_sheets(wf, rootdir, include_sheets=True):
+    """Return lists of all groups and sheets under rootdir.
+
+    Read from the indexer's columnar store, if it is ready and writing one,
+    else from the tree returned by load_tree.
+    """
+    if use_columnar_store(wf) and is_ready(wf):
+        store = columnar_tree.load(wf, rootdir)
+        if store is not None:
+            return store.walk()
+    return parse_ulysses.walk(load_tree(wf, rootdir, include_sheets))
+
+
+def load_tree(wf, rootdir, include_sheets=True):
+    """Return tree for rootdir, without walking library if indexer is ready.
+
+    Falls back to an incremental rebuild of the cached tree until the
+    indexer has finished its start-up rebuild (see is_ready). If sheets are
+    not needed, just the groups are read: from the indexer's snapshot of
+    them if it is ready, else from the library, never looking inside a
+    sheet; the indexer brings the full tree up to date meanwhile.
+    """
+    if not include_sheets:
+        if is_ready(wf):
+            tree = parse_ulysses.cached_tree(wf, rootdir, include_sheets=False)
+            if tree is not None:
+                return tree
+        else:
+            return parse_ulysses.create_tree(rootdir, None,
+                                             include_sheets=False)
+    tree = parse_ulysses.cached_tree(wf, rootdir)
+    if tree is not None and is_ready(wf):
+        return tree
+    return parse_ulysses.update_tree(wf, rootdir, tree)
+
+
+def load_scope_group(wf, rootdir, scope_dir, include_sheets=True):
+    """Return group at scope_dir, building only its subtree if need be.
+
+    Uses the indexer's snapshot if it is ready. Otherwise just the scope
+    group and the groups above it are parsed, so drilling down costs time
+    proportional to the size of that group. KeyError if scope_dir is not in
+    the tree under rootdir.
+    """
+    parse_ulysses.group_path_components(rootdir, scope_dir)
+    if is_ready(wf):
+        if use_columnar_store(wf):
+            store = columnar_tree.load(wf, rootdir)
+            if store is not None:
+                return store.find_group_by_path(scope_dir)
+        tree = None
+        if not include_sheets:
+            tree = parse_ulysses.cached_tree(wf, rootdir, include_sheets=False)
+        if tree is None:
+            tree = parse_ulysses.cached_tree(wf, rootdir)
+        if tree is not None:
+            return parse_ulysses.find_group_by_path(tree, scope_dir)
+    return parse_ulysses.create_scoped_tree(rootdir, scope_dir, include_sheets)
+
+
+if __name__ == "__main__":
+    wf = workflow.workflow3.Workflow3()
+    logger = wf.logger
+    sys.exit(wf.run(main))
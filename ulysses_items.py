@@ -10,7 +10,9 @@ from workflow.workflow3 import Workflow3
 from workflow.workflow import MATCH_ALL, MATCH_ALLCHARS
 from workflow.workflow import ICON_WARNING
 
-import parse_ulysses
+import ulysses_indexer
+import content_search
+import fuzzy
 from parse_ulysses import ICLOUD_GROUPS_ROOT, ICLOUD_UNFILED_ROOT,\
                           LOCAL_GROUPS_ROOT, LOCAL_UNFILED_ROOT
 
@@ -32,6 +34,8 @@ GROUP_BULLET = u'\u25B6'  # black triangle
 INBOX_BULLET = u'\u25B7'  # white triangle
 INBOX_SHEET_BULLET = u'\u25E6'  # white bullet
 
+DEFAULT_MAX_RESULTS = 50  # a few pages of Alfred results
+
 logger = None
 
 EXTRA_DEBUG = False
@@ -51,9 +55,19 @@ def main(wf):
     parser.add_argument('--search-content', dest='search_content',
                         action='store_true',
                         help='search inside content')
+    parser.add_argument('--content-backend', dest='content_backend',
+                        choices=sorted(content_search.BACKENDS),
+                        help='how to search inside content (defaults to '
+                             "'content_backend' setting, else '%s')"
+                             % content_search.DEFAULT_BACKEND)
     parser.add_argument('--search-ulysses-path', dest='search_ulysses_path',
                         action='store_true',
                         help='search full path to item, not just node name')
+    parser.add_argument('--max-results', dest='max_results', type=int,
+                        default=DEFAULT_MAX_RESULTS,
+                        help='most items to return for a query, of each '
+                             'kind when searching content, or 0 for all '
+                             '(default %i)' % DEFAULT_MAX_RESULTS)
 
     args = parser.parse_args(wf.args)
     logger.info('~' * 79)
@@ -64,6 +78,13 @@ def main(wf):
     # Check for updates
     check_for_workflow_update(wf)
 
+    # Drop data kept for refining queries in earlier sessions
+    if not os.getenv('_WF_SESSION_ID'):
+        wf.clear_session_cache()
+
+    # Keep library trees warm in the background for subsequent calls
+    ulysses_indexer.start_indexer(wf)
+
     # Parse entire ulysses data structure
     include_groups = args.kind in ('group', 'all')
     include_sheets = args.kind in ('sheet', 'all')
@@ -85,7 +106,7 @@ def main(wf):
         if os.path.exists(rootdir):
             logger.info("Added %s items from '%s'" % (label, rootdir))
             more_groups, more_sheets = parse_ulysses_for_groups_and_sheets(
-                rootdir, args.limit_scope_dir, include_groups,
+                wf, rootdir, args.limit_scope_dir, include_groups,
                 include_sheets)
             groups.extend(more_groups)
             sheets.extend(more_sheets)
@@ -95,7 +116,16 @@ def main(wf):
     # filter on internal conent if applicable. Only really impacts sheets, but
     # use method on groups for simplicity.
     if args.search_content and args.query:
-        groups, sheets = filter_based_on_content(groups, sheets, args.query)
+        groups, sheets = filter_based_on_content(wf, groups, sheets,
+                                                 args.query,
+                                                 args.content_backend,
+                                                 args.max_results)
+
+    # Cap each kind on its own, after any ranking by the backend, so that
+    # groups, which come first, cannot push out sheets
+    if args.search_content and args.query and args.max_results:
+        groups = groups[:args.max_results]
+        sheets = sheets[:args.max_results]
 
     # Merge groups and sheets to create a single list of nodes
     nodes = groups + sheets
@@ -103,7 +133,9 @@ def main(wf):
     # Filter nodes using fuzzy matching for {query}
     if args.query and not args.search_content:
         search_whole_path = args.search_ulysses_path or args.kind == 'group'
-        nodes = fuzzy_filter_nodes(wf, nodes, args.query, search_whole_path)
+        corpus_name = args.kind + ('-scoped' if args.limit_scope_dir else '')
+        nodes = fuzzy_filter_nodes(wf, nodes, args.query, search_whole_path,
+                                   corpus_name, args.max_results)
 
     # Show error if there are no results. Otherwise, Alfred will show
     # its fallback searches (i.e. "Search Google for 'XYZ'")
@@ -131,6 +163,8 @@ def validify_args(args):
         args.query = args.query.strip()
     if args.search_ulysses_path and args.search_content:
         raise Exception('search-ulysses-path incompatible with search-content')
+    assert args.max_results >= 0, \
+        'max-results must not be negative: %i' % args.max_results
 
 
 def check_for_workflow_update(wf):
@@ -142,22 +176,23 @@ def check_for_workflow_update(wf):
 
 
 def parse_ulysses_for_groups_and_sheets(
-        root_dir, limit_scope_dir, include_groups, include_sheets):
+        wf, root_dir, limit_scope_dir, include_groups, include_sheets):
     """Parse entire Ulysses trees and return list of groups and sheets"""
 
-    # Get ulysses groups & sheets from iCloud
-    groups_tree = parse_ulysses.create_tree(root_dir, None)
     if limit_scope_dir:
+        # Get just the group being drilled into, if it is in this tree
         try:
-            group_to_search = parse_ulysses.find_group_by_path(groups_tree,
-                                                           limit_scope_dir)
+            group_to_search = ulysses_indexer.load_scope_group(
+                wf, root_dir, limit_scope_dir, include_sheets)
             groups = group_to_search.child_groups
             sheets = group_to_search.child_sheets
         except KeyError:
             groups = []
             sheets = []
     else:
-        groups, sheets = parse_ulysses.walk(groups_tree)
+        # Get ulysses groups & sheets, from the indexer's snapshot if available
+        groups, sheets = ulysses_indexer.load_groups_and_sheets(
+            wf, root_dir, include_sheets)
     if not include_groups:
         groups = []
     if not include_sheets:
@@ -165,29 +200,43 @@ def parse_ulysses_for_groups_and_sheets(
     return groups, sheets
 
 
-def filter_based_on_content(groups, sheets, query):
+def filter_based_on_content(wf, groups, sheets, query, backend_name=None,
+                            max_results=0):
     """Filter lists of groups and sheets.
 
-    Return only items which are also find by spotlight's mdfind.
+    Return only items whose content matches query, as found by the named
+    content_search backend, or the one in the 'content_backend' setting.
+    The backend may stop once it has found max_results of each kind, if
+    not 0, but may return more.
     """
-    logger.info('>>> Filtering content with "%s"' % query)
-    groups = parse_ulysses.filter_groups(groups, query)
-    sheets = parse_ulysses.filter_sheets(sheets, query)
-    return groups, sheets
-
-
-def fuzzy_filter_nodes(wf, nodes, query, search_whole_path):
+    backend = content_search.get_backend(wf, backend_name)
+    logger.info('>>> Filtering content with "%s" using %s backend'
+                % (query, backend.name))
+    # The indexer prepares only the backend in the 'content_backend' setting
+    indexed = (ulysses_indexer.is_ready(wf) and
+               backend.name == content_search.get_backend(wf).name)
+    return backend.filter(wf, groups, sheets, query, indexed=indexed,
+                          max_results=max_results)
+
+
+def fuzzy_filter_nodes(wf, nodes, query, search_whole_path, corpus_name,
+                       max_results=0):
     """Filter list of nodes with query.
 
     If search_whole_path is true then search the Ulysses path for query,
-    otherwise just the name of the sheet or group.
+    otherwise just the name of the sheet or group. Keys are prepared for
+    matching once and cached under corpus_name until they change, with a
+    trigram index unless the 'fuzzy_index' setting is false, and scored in
+    batch unless the 'fuzzy_batch' setting is false. At most
+    max_results of the best matching nodes are returned, if given.
     """
     def expanded_node_path(node):
-        path_list = node.get_alfred_path_list()
-        path_list.append(node.title)
+        # Groups hold their path joined already, so just the title is added
+        path = node.ancestor_alfred_path
+        path = path + ' ' + node.title if path else node.title
         if EXTRA_DEBUG:
-            logger.info(' '.join(path_list))
-        return ' '.join(path_list)
+            logger.info(path)
+        return path
 
     def node_title(node):
         return node.title
@@ -199,9 +248,17 @@ def fuzzy_filter_nodes(wf, nodes, query, search_whole_path):
     logger.info('Fuzzy matching with query="%s" and key func="%s"'
                 % (query, key_func.__name__))
     # See: http://www.deanishe.net/alfred-workflow/user-manual/filtering.html
-    nodes = wf.filter(query, nodes, key_func,
-                      match_on=MATCH_ALL ^ MATCH_ALLCHARS)
-    return nodes
+    corpus = fuzzy.load_corpus(wf, corpus_name + '-' + key_func.__name__,
+                               [key_func(node) for node in nodes],
+                               index=wf.settings.get('fuzzy_index', True))
+    fold_diacritics = wf.settings.get('__workflow_diacritic_folding', True)
+    results = fuzzy.filter_in_session(wf, corpus_name, corpus, query,
+                                      match_on=MATCH_ALL ^ MATCH_ALLCHARS,
+                                      fold_diacritics=fold_diacritics,
+                                      max_results=max_results,
+                                      batch=wf.settings.get('fuzzy_batch',
+                                                            True))
+    return [nodes[i] for i, _, _ in results]
 
 
 def alfredworkflow(arg, node_type='', search_in='', content_query='',
@@ -231,8 +288,8 @@ def add_ulysses_item_to_wf_results(wf, args, node):
 
     Return item for subsequent modification
     """
-    pathlist = path_list_from_main(node)
-    ulysses_path = '/'.join([''] + pathlist)
+    ancestor_path = node.ancestor_path
+    ulysses_path = ancestor_path
     if node.is_group:
         ulysses_path += '/' + node.name
         if ulysses_path == '/Inbox':
@@ -260,7 +317,7 @@ def add_ulysses_item_to_wf_results(wf, args, node):
     content_query = args.query if args.search_content else ''
     item = wf.add_item(
         title,
-        subtitle='      ' + '/' + '/'.join(pathlist) + metadata,
+        subtitle='      ' + (ancestor_path or '/') + metadata,
         arg=alfredworkflow(node.openable_file, node_type,
                            content_query=content_query,
                            kind_requested=args.kind,
@@ -275,12 +332,11 @@ def add_ulysses_item_to_wf_results(wf, args, node):
 
 def add_modifier_to_go_up_hierarchy(args, node, item):
     """Add shift modifier to Ulysses item to request move up hierarchy."""
-    ancestors = list(node.get_ancestors())
+    ancestors = node.ancestors
     try:
-        current_group = ancestors.pop()  # this is actually the group we are in
-        next_group_up = ancestors.pop()
-        path_list = path_list_from_main(current_group)
-        next_group_up_path = '/' + '/'.join(path_list)
+        current_group = ancestors[-1]  # this is actually the group we are in
+        next_group_up = ancestors[-2]
+        next_group_up_path = current_group.ancestor_path or '/'
     except IndexError:
         next_group_up = None
     content_query = args.query if args.search_content else ''
@@ -315,8 +371,7 @@ def add_modifier_to_drill_down_hierarchy(args, node, item):
     content_query = args.query if args.search_content else ''
 
     if drillable:
-        pathlist = path_list_from_main(node)
-        subtitle = '     Go into: ' + '/'.join(pathlist) + '/' + node.name
+        subtitle = '     Go into: ' + node.ancestor_path[1:] + '/' + node.name
         arg = alfredworkflow('', 'group', search_in=node.dirpath,
                              content_query=content_query,
                              kind_requested=args.kind)
@@ -331,14 +386,6 @@ def add_modifier_to_drill_down_hierarchy(args, node, item):
         item.add_modifier('cmd', subtitle='     ' + subtitle, valid=False)
 
 
-def path_list_from_main(node):
-    """Return Ulysses path as list, not including the inetrnally named Main node"""
-    pathlist = node.get_alfred_path_list()
-    if pathlist and (pathlist[0] == 'Main'):
-        pathlist = pathlist[1:]
-    return pathlist
-
-
 if __name__ == "__main__":
     wf = Workflow3(help_url=HELP_URL,
                    update_settings=UPDATE_SETTINGS)